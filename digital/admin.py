@@ -1,8 +1,13 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.template.response import TemplateResponse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
+from . import search
 from .models import *
-from .forms import CategoryForm
+from .forms import CategoryForm, BulkPriceQuantityForm
+from .pagination import EstimatedCountPaginator
 # Register your models here.
 
 from .forms import Category
@@ -17,6 +22,8 @@ admin.site.register(Order)
 admin.site.register(OrderProduct)
 admin.site.register(ShippingAdress)
 admin.site.register(City)
+admin.site.register(RelatedProduct)
+admin.site.register(PaymentEvent)
 
 
 class GalleryInline(admin.TabularInline):
@@ -34,6 +41,7 @@ class ParameterInline(admin.TabularInline):
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('pk', 'title', 'get_image_category')
+    search_fields = ('title',)
     prepopulated_fields = {'slug': ['title']}
     form = CategoryForm
     list_display_links = ('pk', 'title', 'get_image_category')
@@ -55,7 +63,9 @@ class CategoryAdmin(admin.ModelAdmin):
 class BrandAdmin(admin.ModelAdmin):
     list_display = ('pk', 'title', 'category')
     list_display_links = ('pk', 'title')
-    list_filter = ['category', 'title']
+    list_filter = ['category']
+    list_select_related = ('category',)
+    search_fields = ('title',)
 
 
 @admin.register(Product)
@@ -65,15 +75,45 @@ class ProductAdmin(admin.ModelAdmin):
     inlines = [GalleryInline, ParameterInline]
     prepopulated_fields = {'slug': ['title']}
     list_editable = ('price', 'quantity')
+    list_select_related = ('category', 'primary_image')
+    autocomplete_fields = ('category', 'brand')
+    search_fields = ('title',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['change_price_quantity']
+
+    def get_search_results(self, request, queryset, search_term):
+        # the full-text index answers the search box, LIKE over the whole catalog does not scale
+        if search_term and search.is_supported():
+            return search.filter_products(queryset, search_term), False
+        return super().get_search_results(request, queryset, search_term)
+
+    @admin.action(description='Изменить цену и количество')
+    def change_price_quantity(self, request, queryset):
+        form = BulkPriceQuantityForm(request.POST if 'apply' in request.POST else None)
+        if form.is_valid():
+            # one UPDATE for every selected row, edited_at retires their cached cards
+            count = queryset.update(edited_at=timezone.now(), **form.get_updates())
+            self.message_user(request, f'Обновлено товаров: {count}', messages.SUCCESS)
+            return None
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Изменить цену и количество',
+            'opts': self.model._meta,
+            'form': form,
+            'count': queryset.count(),
+            'action': 'change_price_quantity',
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            'select_across': request.POST.get('select_across', '0'),
+        }
+        return TemplateResponse(request, 'admin/digital/product/change_price_quantity.html', context)
 
     def get_image_product(self, obj):
-        if obj.images:
-            try:
-                return mark_safe(f'<img src="{obj.images.all()[0].image.url}" width="100">')
-            except Exception as e:
-                print(e)
-                return '-'
-        else:
+        url = obj.get_image_product()
+        if url == '-':
             return '-'
+        return mark_safe(f'<img src="{url}" width="100">')
 
     get_image_product.short_description = 'Картинка товара'
@@ -0,0 +1,92 @@
+import time
+
+from .models import Category
+from .shared_version import SharedVersion
+
+TREE_VERSION = SharedVersion('category_tree:version', timeout=300)
+
+_tree = {'value': None, 'version': None, 'built_at': 0}
+
+
+# a plain copy of a Category with its url, image url and children resolved once,
+# templates use it exactly like the model
+class CategoryNode:
+    def __init__(self, category):
+        self.pk = category.pk
+        self.title = category.title
+        self.slug = category.slug
+        self.parent_id = category.parent_id
+        self.url = category.get_absolute_url() if category.slug else '#'
+        self.image_url = category.get_image_category()
+        self.subcategories = []
+
+    def get_absolute_url(self):
+        return self.url
+
+    def get_image_category(self):
+        return self.image_url
+
+    def __str__(self):
+        return self.title
+
+
+def _build():
+    nodes = {category.pk: CategoryNode(category) for category in Category.objects.order_by('pk')}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node.parent_id)
+        if parent is None:
+            roots.append(node)
+        else:
+            parent.subcategories.append(node)
+
+    slugs = {node.slug: node.pk for node in nodes.values() if node.slug}
+    return {'nodes': nodes, 'roots': roots, 'slugs': slugs}
+
+
+def get_tree():
+    version = TREE_VERSION.current()
+    tree = _tree['value']
+    if tree is None or not TREE_VERSION.is_current(_tree['version'], _tree['built_at'], version):
+        tree = _build()
+        _tree.update(value=tree, version=version, built_at=time.monotonic())
+    return tree
+
+
+def clear():
+    _tree['value'] = None
+    TREE_VERSION.bump()
+
+
+def get_root_categories():
+    return get_tree()['roots']
+
+
+def get_category(category_id):
+    return get_tree()['nodes'].get(category_id)
+
+
+def get_category_id(slug):
+    return get_tree()['slugs'].get(slug)
+
+
+def get_descendant_ids(category_id):
+    nodes = get_tree()['nodes']
+    ids = [category_id]
+    seen = {category_id}
+    for pk in ids:
+        for child in nodes[pk].subcategories:
+            if child.pk not in seen:
+                seen.add(child.pk)
+                ids.append(child.pk)
+    return ids
+
+
+def get_breadcrumbs(category_id):
+    nodes = get_tree()['nodes']
+    breadcrumbs = []
+    node = nodes.get(category_id)
+    while node is not None and node not in breadcrumbs:
+        breadcrumbs.insert(0, node)
+        node = nodes.get(node.parent_id)
+    return breadcrumbs
@@ -0,0 +1,15 @@
+from django.utils.functional import SimpleLazyObject
+
+from .utils import get_request_favorite_ids, get_cart_summary
+
+
+def favorites(request):
+    return {
+        'favorite_ids': SimpleLazyObject(lambda: get_request_favorite_ids(request))
+    }
+
+
+def cart_summary(request):
+    return {
+        'cart_summary': SimpleLazyObject(lambda: get_cart_summary(request))
+    }
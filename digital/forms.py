@@ -1,6 +1,7 @@
 from django import forms
+from django.db.models import F
 
-from .models import Category, Profile, ShippingAdress, Customer
+from .models import Category, Profile, ShippingAdress, Customer, Brand
 from django_svg_image_form_field import SvgAndImageFormField
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm, UserChangeForm
@@ -167,3 +168,76 @@ class ShippingForm(forms.ModelForm):
             })
 
         }
+
+
+class ProductFilterForm(forms.Form):
+    SORT_CHOICES = [
+        ('new', 'Сначала новые'),
+        ('old', 'Сначала старые'),
+        ('cheap', 'Сначала дешёвые'),
+        ('expensive', 'Сначала дорогие'),
+    ]
+
+    sort = forms.ChoiceField(required=False, choices=SORT_CHOICES, widget=forms.Select(attrs={
+        'class': 'form-select'
+    }))
+
+    price_min = forms.FloatField(required=False, min_value=0, widget=forms.NumberInput(attrs={
+        'class': 'form-control',
+        'placeholder': 'Цена от'
+    }))
+
+    price_max = forms.FloatField(required=False, min_value=0, widget=forms.NumberInput(attrs={
+        'class': 'form-control',
+        'placeholder': 'Цена до'
+    }))
+
+    brand = forms.ModelChoiceField(required=False, queryset=Brand.objects.none(), empty_label='Все бренды',
+                                   widget=forms.Select(attrs={
+                                       'class': 'form-select'
+                                   }))
+
+    color = forms.CharField(required=False, widget=forms.TextInput(attrs={
+        'class': 'form-control',
+        'placeholder': 'Цвет'
+    }))
+
+
+class BulkPriceQuantityForm(forms.Form):
+    PRICE_CHOICES = [
+        ('', 'Не менять'),
+        ('set', 'Установить'),
+        ('percent', 'Изменить на %'),
+    ]
+    QUANTITY_CHOICES = [
+        ('', 'Не менять'),
+        ('set', 'Установить'),
+        ('add', 'Добавить'),
+    ]
+
+    price_mode = forms.ChoiceField(required=False, choices=PRICE_CHOICES, label='Цена')
+    price_value = forms.FloatField(required=False, label='Значение цены')
+    quantity_mode = forms.ChoiceField(required=False, choices=QUANTITY_CHOICES, label='Количество')
+    quantity_value = forms.IntegerField(required=False, label='Значение количества')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for field in ('price', 'quantity'):
+            if cleaned_data.get(f'{field}_mode') and cleaned_data.get(f'{field}_value') is None:
+                self.add_error(f'{field}_value', 'Укажите значение')
+        if not cleaned_data.get('price_mode') and not cleaned_data.get('quantity_mode'):
+            raise forms.ValidationError('Выберите, что изменить')
+        return cleaned_data
+
+    def get_updates(self):
+        data = self.cleaned_data
+        updates = {}
+        if data['price_mode'] == 'set':
+            updates['price'] = data['price_value']
+        elif data['price_mode'] == 'percent':
+            updates['price'] = F('price') * (1 + data['price_value'] / 100)
+        if data['quantity_mode'] == 'set':
+            updates['quantity'] = data['quantity_value']
+        elif data['quantity_mode'] == 'add':
+            updates['quantity'] = F('quantity') + data['quantity_value']
+        return updates
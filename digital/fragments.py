@@ -0,0 +1,35 @@
+from collections import Counter
+
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+CACHE_ALIAS = 'fragments'
+CARD_TIMEOUT = 60 * 60 * 24
+FAVORITE_PLACEHOLDER = '<!-- favorite -->'
+
+stats = Counter()
+
+
+def product_card_key(product):
+    # edited_at is part of the key, so a saved product simply stops matching its old card
+    return f'product_card:{product.pk}:{product.edited_at.timestamp()}'
+
+
+def render_product_card(product, is_favorite):
+    cache = caches[CACHE_ALIAS]
+    key = product_card_key(product)
+    html = cache.get(key)
+    if html is None:
+        stats['misses'] += 1
+        html = render_to_string('digital/components/_product_card.html', {'product': product})
+        cache.set(key, html, CARD_TIMEOUT)
+    else:
+        stats['hits'] += 1
+
+    # the heart depends on the user, so it is rendered per request and never cached
+    favorite = render_to_string('digital/components/_product_favorite.html', {
+        'product': product,
+        'is_favorite': is_favorite
+    })
+    return mark_safe(html.replace(FAVORITE_PLACEHOLDER, favorite))
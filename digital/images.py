@@ -0,0 +1,78 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+# every picture gets WebP copies of these widths plus one of its own width, never upscaled
+VARIANT_WIDTHS = (320, 640, 1280)
+# product cards and the basket show the first variant at least this wide
+CARD_WIDTH = 640
+WEBP_QUALITY = 80
+
+
+def variant_name(name, width):
+    directory, filename = os.path.split(name)
+    return os.path.join(directory, 'variants', f'{os.path.splitext(filename)[0]}-{width}w.webp')
+
+
+def build_variants(name, storage=None):
+    # the original is read from the storage of its field, the copies always go to the default storage
+    with (storage or default_storage).open(name, 'rb') as source:
+        image = ImageOps.exif_transpose(Image.open(source))
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'PA', 'P') else 'RGB')
+
+    widths = [width for width in VARIANT_WIDTHS if width < image.width] + [image.width]
+    for width in widths:
+        variant = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+        buffer = BytesIO()
+        variant.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=4)
+        target = variant_name(name, width)
+        # the name is stable, an old copy is replaced instead of getting a random suffix
+        if default_storage.exists(target):
+            default_storage.delete(target)
+        default_storage.save(target, ContentFile(buffer.getvalue()))
+    return {'source': name, 'widths': widths}
+
+
+def delete_variants(variants):
+    for width in variants.get('widths', []):
+        default_storage.delete(variant_name(variants['source'], width))
+
+
+def _build_or_skip(name):
+    from .models import Gallery
+
+    # runs in a worker process, a missing or broken file must not stop the whole backfill
+    try:
+        return build_variants(name, Gallery._meta.get_field('image').storage)
+    except OSError:
+        return None
+
+
+def backfill_variants(force=False, workers=None):
+    from .models import Gallery, Product
+
+    pending = [(pk, name) for pk, name, variants in Gallery.objects.order_by('pk').values_list('pk', 'image', 'variants')
+               if name and (force or variants.get('source') != name)]
+    if not pending:
+        return 0, 0
+
+    # forked workers must not share the parent's database connection
+    connections.close_all()
+    done = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_build_or_skip, [name for _, name in pending], chunksize=16)
+        for (pk, name), variants in zip(pending, results):
+            if variants is not None and Gallery.objects.filter(pk=pk, image=name).update(variants=variants):
+                done.append(pk)
+
+    # cached product cards still point at the originals
+    Product.objects.filter(images__pk__in=done).update(edited_at=timezone.now())
+    return len(done), len(pending) - len(done)
@@ -0,0 +1,42 @@
+import glob
+import json
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from digital.static_build import budget_report, find_page_assets, find_unused_assets
+
+
+class Command(BaseCommand):
+    help = 'Собирает статику: убирает неиспользуемые файлы, урезает шрифты, сжимает и проверяет бюджет страниц'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-prune', action='store_true', help='Собрать и неиспользуемые файлы проекта')
+        parser.add_argument('--no-clear', action='store_true', help='Не очищать STATIC_ROOT перед сборкой')
+        parser.add_argument('--report', default=str(settings.BASE_DIR / 'static-report.json'),
+                            help='Куда записать отчёт о размерах страниц')
+        parser.add_argument('--budget', type=int, default=None, help='Бюджет страницы в КБ после сжатия')
+        parser.add_argument('--strict', action='store_true', help='Завершиться с ошибкой при превышении бюджета')
+
+    def handle(self, *args, **options):
+        unused = [] if options['no_prune'] else find_unused_assets()
+        call_command('collectstatic', interactive=False, clear=not options['no_clear'], verbosity=0,
+                     ignore_patterns=[glob.escape(path) for path in unused])
+        self.stdout.write(f'Пропущено неиспользуемых файлов: {len(unused)}')
+
+        report = budget_report(find_page_assets(), options['budget'])
+        with open(options['report'], 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+        over_budget = []
+        for page, sizes in report.items():
+            line = f'{page}: {sizes["transfer"] // 1024} КБ (без сжатия {sizes["raw"] // 1024} КБ)'
+            if sizes['over_budget']:
+                over_budget.append(page)
+                self.stdout.write(self.style.WARNING(f'{line} - больше бюджета {sizes["budget"] // 1024} КБ'))
+            else:
+                self.stdout.write(self.style.SUCCESS(line))
+
+        if over_budget and options['strict']:
+            raise CommandError(f'Страниц больше бюджета: {len(over_budget)}')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from digital.images import backfill_variants
+
+
+class Command(BaseCommand):
+    help = 'Создаёт уменьшенные WebP-копии картинок товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Пересоздать копии и для уже обработанных картинок')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов (по умолчанию - по числу ядер)')
+
+    def handle(self, *args, **options):
+        done, failed = backfill_variants(force=options['all'], workers=options['workers'])
+        self.stdout.write(self.style.SUCCESS(f'Обработано картинок: {done}'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'Не удалось обработать: {failed}'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from digital.media import is_hashed
+from digital.models import Category, Gallery
+
+
+class Command(BaseCommand):
+    help = 'Переименовывает загруженные ранее картинки по хешу содержимого, одинаковые файлы хранятся один раз'
+
+    def handle(self, *args, **options):
+        renamed = failed = 0
+        for model in (Category, Gallery):
+            for obj in model.objects.exclude(image='').exclude(image__isnull=True).order_by('pk'):
+                if is_hashed(obj.image.name):
+                    continue
+                storage = obj.image.storage
+                try:
+                    with storage.open(obj.image.name, 'rb') as file:
+                        name = storage.save(obj.image.name, file)
+                except OSError:
+                    failed += 1
+                    continue
+                # the old file stays, pages rendered before the rename may still point at it
+                obj.image.name = name
+                obj.save(update_fields=['image'])
+                renamed += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Переименовано файлов: {renamed}'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'Не найдено файлов: {failed}'))
+        if renamed:
+            self.stdout.write('Запустите generate_image_variants, чтобы создать копии для новых имён')
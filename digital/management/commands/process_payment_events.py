@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from digital.payments import process_payment_events
+
+
+class Command(BaseCommand):
+    help = 'Завершает оплаченные заказы по событиям Stripe'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Повторять каждые N секунд (0 - выполнить один раз)')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_payment_events(batch_size=options['batch_size'])
+            if processed or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(f'Обработано событий: {processed}'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from digital.utils import refresh_primary_images
+
+
+class Command(BaseCommand):
+    help = 'Заново выбирает главную картинку каждого товара'
+
+    def handle(self, *args, **options):
+        count = refresh_primary_images()
+        self.stdout.write(self.style.SUCCESS(f'Обновлено товаров: {count}'))
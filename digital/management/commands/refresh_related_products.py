@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from digital.recommendations import refresh_related_products, get_stale_product_ids
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает похожие товары для страницы товара'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Пересчитать все товары, а не только изменённые')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Повторять обновление каждые N секунд (0 - выполнить один раз)')
+
+    def handle(self, *args, **options):
+        while True:
+            product_ids = None if options['all'] else sorted(get_stale_product_ids())
+            count = refresh_related_products(product_ids, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Обновлено товаров: {count}'))
+
+            if not options['interval']:
+                break
+            options['all'] = False
+            time.sleep(options['interval'])
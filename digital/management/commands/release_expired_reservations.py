@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from digital.utils import release_expired_reservations, get_stock_metrics
+
+
+class Command(BaseCommand):
+    help = 'Возвращает на склад товары из брошенных корзин'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=None,
+                            help='Сколько минут держать резерв (по умолчанию CART_RESERVATION_MINUTES)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Повторять каждые N секунд (0 - выполнить один раз)')
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_reservations(options['minutes'], batch_size=options['batch_size'])
+            metrics = get_stock_metrics()
+            self.stdout.write(self.style.SUCCESS(
+                f'Освобождено позиций: {released}. На складе: {metrics["available"]}, '
+                f'в резерве: {metrics["reserved"]}, нет в наличии товаров: {metrics["sold_out_products"]}'
+            ))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,121 @@
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.deconstruct import deconstructible
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+HASH_LENGTH = 32
+# a content hash, optionally with the width suffix of an image variant
+HASHED_NAME = re.compile(rf'^([0-9a-f]{{{HASH_LENGTH}}})(-\d+w)?\.\w+$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MEDIA_CACHE_CONTROL = 'public, max-age=3600'
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+# uploads are named after the hash of their content: identical files share one copy on disk,
+# and a name never starts pointing at other bytes, so it can be cached forever
+@deconstructible
+class HashedMediaStorage(FileSystemStorage):
+    def get_hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        return os.path.join(directory, digest.hexdigest()[:HASH_LENGTH] + os.path.splitext(filename)[1].lower())
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_hashed_name(name, content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+def is_hashed(name):
+    return HASHED_NAME.match(os.path.basename(name)) is not None
+
+
+def parse_range(header, size):
+    # only a single "bytes=" range is supported, anything else gets the whole file
+    match = RANGE_HEADER.match(header or '')
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        return max(size - int(last), 0), size - 1
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve(request, path):
+    fullpath = safe_join(settings.MEDIA_ROOT, path)
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    stat = os.stat(fullpath)
+    name = os.path.basename(fullpath)
+    hashed = HASHED_NAME.match(name)
+    etag = f'"{hashed.group(0)}"' if hashed else f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if hashed else MEDIA_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is not None:
+        for header, value in headers.items():
+            response.headers[header] = value
+        return response
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+    byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+    # a range of an older version of the file is not wanted, the client gets the whole new one
+    if byte_range is not None and request.headers.get('If-Range', etag) != etag:
+        byte_range = None
+
+    if byte_range is None:
+        response = FileResponse(open(fullpath, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        if start > end or start >= stat.st_size:
+            response = HttpResponse(status=416, content_type=content_type)
+            response.headers['Content-Range'] = f'bytes */{stat.st_size}'
+        else:
+            response = StreamingHttpResponse(_read_range(fullpath, start, end - start + 1), status=206,
+                                             content_type=content_type)
+            response.headers['Content-Length'] = end - start + 1
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response.headers[header] = value
+    return response
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:24
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0018_remove_orderproduct_user'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='gallery',
+            options={'ordering': ['pk'], 'verbose_name': 'Картинка', 'verbose_name_plural': 'Картинки'},
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+CREATE_SQL = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS digital_product_search
+    USING fts5(title, description, brand, parameters, tokenize='unicode61 remove_diacritics 2', prefix='2 3')
+'''
+
+FILL_SQL = '''
+    INSERT INTO digital_product_search(rowid, title, description, brand, parameters)
+    SELECT p.id, p.title, COALESCE(p.description_all, ''), COALESCE(b.title, ''),
+           COALESCE((SELECT group_concat(d.parameter || ' ' || d.parameter_info, ' ')
+                     FROM digital_productdescription d WHERE d.product_id = p.id), '')
+    FROM digital_product p
+    LEFT JOIN digital_brand b ON b.id = p.brand_id
+'''
+
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_SQL)
+    schema_editor.execute(FILL_SQL)
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS digital_product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0020_relatedproduct'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:31
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    OrderProduct = apps.get_model('digital', 'OrderProduct')
+    duplicates = (OrderProduct.objects.filter(order__isnull=False, product__isnull=False)
+                  .values('order_id', 'product_id')
+                  .annotate(lines=Count('id'), total=Sum('quantity'))
+                  .filter(lines__gt=1))
+    for duplicate in duplicates:
+        lines = OrderProduct.objects.filter(order_id=duplicate['order_id'], product_id=duplicate['product_id'])
+        first = lines.order_by('pk').first()
+        lines.exclude(pk=first.pk).delete()
+        first.quantity = duplicate['total']
+        first.save(update_fields=['quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0022_product_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='orderproduct',
+            constraint=models.UniqueConstraint(fields=('order', 'product'), name='unique_order_product'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0023_orderproduct_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='ID события')),
+                ('type', models.CharField(max_length=255, verbose_name='Тип события')),
+                ('payload', models.JSONField(verbose_name='Данные')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='Получено')),
+                ('processed_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Обработано')),
+            ],
+            options={
+                'verbose_name': 'Платёжное событие',
+                'verbose_name_plural': 'Платёжные события',
+            },
+        ),
+        migrations.AddField(
+            model_name='orderproduct',
+            name='price',
+            field=models.FloatField(blank=True, null=True, verbose_name='Цена на момент покупки'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0024_payment_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.FloatField(blank=True, null=True, verbose_name='Сумма заказа'),
+        ),
+        migrations.AddField(
+            model_name='orderproduct',
+            name='image_url',
+            field=models.CharField(blank=True, default='', max_length=500, verbose_name='Картинка на момент покупки'),
+        ),
+        migrations.AddField(
+            model_name='orderproduct',
+            name='title',
+            field=models.CharField(blank=True, default='', max_length=250, verbose_name='Название на момент покупки'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:44
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Concat
+
+
+def fill_order_totals(apps, schema_editor):
+    # orders paid before the snapshot get their lines' snapshot and their total once,
+    # so the history never reads the catalog or sums lines
+    Order = apps.get_model('digital', 'Order')
+    OrderProduct = apps.get_model('digital', 'OrderProduct')
+    Product = apps.get_model('digital', 'Product')
+    Gallery = apps.get_model('digital', 'Gallery')
+    product = Product.objects.filter(pk=OuterRef('product_id'))
+    first_image = Gallery.objects.filter(product=OuterRef('product_id')).order_by('pk').values('image')[:1]
+    OrderProduct.objects.filter(order__is_completed=True, product__isnull=False, price__isnull=True).update(
+        price=Subquery(product.values('price')[:1]),
+        title=Subquery(product.values('title')[:1]),
+        image_url=Coalesce(Concat(Value(settings.MEDIA_URL), Subquery(first_image)), Value(''))
+    )
+
+    order_total = (OrderProduct.objects.filter(order=OuterRef('pk')).order_by().values('order')
+                   .annotate(total=Sum(F('quantity') * Coalesce('price', 'product__price'),
+                                       output_field=models.FloatField()))
+                   .values('total'))
+    Order.objects.filter(is_completed=True, total_price__isnull=True).update(
+        total_price=Coalesce(Subquery(order_total), 0.0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0025_order_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'is_completed', '-created_at', '-id'], name='order_history_idx'),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0026_order_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallery',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
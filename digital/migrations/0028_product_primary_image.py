@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_primary_images(apps, schema_editor):
+    Product = apps.get_model('digital', 'Product')
+    Gallery = apps.get_model('digital', 'Gallery')
+    first_image = Gallery.objects.filter(product=OuterRef('pk')).order_by('pk').values('pk')[:1]
+    Product.objects.update(primary_image=Subquery(first_image))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0027_gallery_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='primary_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='digital.gallery', verbose_name='Главная картинка'),
+        ),
+        migrations.RunPython(fill_primary_images, migrations.RunPython.noop),
+    ]
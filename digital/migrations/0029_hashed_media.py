@@ -0,0 +1,24 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:50
+
+import digital.media
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0028_product_primary_image'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=digital.media.HashedMediaStorage(), upload_to='categories/', verbose_name='Изображение'),
+        ),
+        migrations.AlterField(
+            model_name='gallery',
+            name='image',
+            field=models.ImageField(storage=digital.media.HashedMediaStorage(), upload_to='products', verbose_name='Картинка товара'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0029_hashed_media'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='checkout_session_id',
+            field=models.CharField(blank=True, default='', max_length=255, verbose_name='Сессия оплаты'),
+        ),
+    ]
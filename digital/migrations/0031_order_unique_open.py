@@ -0,0 +1,45 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:22
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_open_orders(apps, schema_editor):
+    # every extra open order of a customer goes into the oldest one, a merged cart starts its checkout anew
+    Order = apps.get_model('digital', 'Order')
+    OrderProduct = apps.get_model('digital', 'OrderProduct')
+    ShippingAdress = apps.get_model('digital', 'ShippingAdress')
+    duplicates = (Order.objects.filter(customer__isnull=False, is_completed=False)
+                  .values('customer_id').annotate(orders=Count('id')).filter(orders__gt=1))
+    for duplicate in duplicates:
+        orders = Order.objects.filter(customer_id=duplicate['customer_id'], is_completed=False).order_by('pk')
+        first = orders.first()
+        for line in OrderProduct.objects.filter(order__in=orders.exclude(pk=first.pk)):
+            kept = OrderProduct.objects.filter(order=first, product_id=line.product_id).first()
+            if kept is None:
+                line.order = first
+                line.save(update_fields=['order'])
+            else:
+                kept.quantity = (kept.quantity or 0) + (line.quantity or 0)
+                kept.save(update_fields=['quantity'])
+                line.delete()
+        ShippingAdress.objects.filter(order__in=orders.exclude(pk=first.pk)).update(order=first)
+        orders.exclude(pk=first.pk).delete()
+        OrderProduct.objects.filter(order=first).update(price=None, title='', image_url='')
+        Order.objects.filter(pk=first.pk).update(total_price=None, checkout_session_id='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital', '0030_order_checkout_session'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_orders, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_completed', False)), fields=('customer',),
+                                               name='unique_open_order'),
+        ),
+    ]
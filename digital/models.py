@@ -1,6 +1,13 @@
 from django.db import models
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+
+from .images import CARD_WIDTH, variant_name
+from .media import HashedMediaStorage
 
 
 # Create your models here.
@@ -8,7 +15,8 @@ from django.contrib.auth.models import User
 
 class Category(models.Model):
     title = models.CharField(max_length=150, verbose_name='Название категории')
-    image = models.ImageField(upload_to='categories/', verbose_name='Изображение', blank=True, null=True)
+    image = models.ImageField(upload_to='categories/', storage=HashedMediaStorage(), verbose_name='Изображение',
+                              blank=True, null=True)
     slug = models.SlugField(unique=True, null=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='subcategories',
                                related_query_name='subcategories', verbose_name='Категория')
@@ -55,31 +63,84 @@ class Product(models.Model):
     color_code = models.TextField(default='#000000', verbose_name='Код цвета', null=True, blank=True)
     color_name = models.TextField(default='Желтый', verbose_name='Цвет', null=True, blank=True)
     description_all = models.TextField(verbose_name='Описание для страницы о товаре', blank=True, null=True)
+    # the first Gallery row, kept up to date by the Gallery signals
+    primary_image = models.ForeignKey('Gallery', on_delete=models.SET_NULL, null=True, blank=True, editable=False,
+                                      related_name='+', verbose_name='Главная картинка')
 
     def get_absolute_url(self):
         return reverse('product_detail', kwargs={'slug': self.slug})
 
     def get_image_product(self):
-        if self.images:
-            try:
-                return self.images.first().image.url
-            except:
-                return '-'
-        else:
+        # lists load primary_image with select_related(), a card costs no query of its own
+        if self.primary_image_id is None:
             return '-'
+        try:
+            return self.primary_image.get_image_url()
+        except ValueError:
+            return '-'
+
+    def get_image_srcset(self):
+        if self.primary_image_id is None:
+            return ''
+        return self.primary_image.get_srcset()
 
     class Meta:
         verbose_name = 'Товар'
         verbose_name_plural = 'Товары'
+        indexes = [
+            models.Index(fields=['category', 'created_at', 'id'], name='product_category_created_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+        ]
+
+
+class RelatedProduct(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_products',
+                                verbose_name='Товар')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_to',
+                                verbose_name='Похожий товар')
+    score = models.FloatField(default=0, verbose_name='Оценка')
+    computed_at = models.DateTimeField(verbose_name='Дата расчёта')
+
+    def __str__(self):
+        return f'{self.product_id} -> {self.related_id}'
+
+    class Meta:
+        verbose_name = 'Похожий товар'
+        verbose_name_plural = 'Похожие товары'
+        ordering = ['-score']
+        indexes = [
+            models.Index(fields=['product', '-score']),
+        ]
 
 
 class Gallery(models.Model):
-    image = models.ImageField(upload_to='products', verbose_name='Картинка товара')
+    image = models.ImageField(upload_to='products', storage=HashedMediaStorage(), verbose_name='Картинка товара')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
+    # {'source': image name, 'widths': [...]} of the WebP copies made by digital.images
+    variants = models.JSONField(default=dict, blank=True, editable=False)
 
     class Meta:
         verbose_name = 'Картинка'
         verbose_name_plural = 'Картинки'
+        ordering = ['pk']
+
+    def get_variant_widths(self):
+        # copies made for a previous file of this row don't count
+        if self.variants.get('source') != self.image.name:
+            return []
+        return self.variants.get('widths', [])
+
+    def get_variant_url(self, width):
+        return default_storage.url(variant_name(self.image.name, width))
+
+    def get_image_url(self):
+        widths = self.get_variant_widths()
+        if not widths:
+            return self.image.url
+        return self.get_variant_url(next((width for width in widths if width >= CARD_WIDTH), widths[-1]))
+
+    def get_srcset(self):
+        return ', '.join(f'{self.get_variant_url(width)} {width}w' for width in self.get_variant_widths())
 
 
 class ProductDescription(models.Model):
@@ -136,6 +197,8 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата заказа')
     is_completed = models.BooleanField(default=False)
     shipping = models.BooleanField(default=True, verbose_name='Строка')
+    total_price = models.FloatField(null=True, blank=True, verbose_name='Сумма заказа')
+    checkout_session_id = models.CharField(max_length=255, blank=True, default='', verbose_name='Сессия оплаты')
 
     def __str__(self):
         return f'Заказ №: {self.pk}'
@@ -143,18 +206,35 @@ class Order(models.Model):
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
+        indexes = [
+            # order history of one customer, newest first
+            models.Index(fields=['customer', 'is_completed', '-created_at', '-id'], name='order_history_idx'),
+        ]
+        constraints = [
+            # a customer has one cart, two first clicks at once can't open a second one
+            models.UniqueConstraint(fields=['customer'], condition=models.Q(is_completed=False),
+                                    name='unique_open_order'),
+        ]
+
+    def calculate_cart_totals(self):
+        return self.orderproduct_set.aggregate(
+            total_price=Coalesce(Sum(F('quantity') * Coalesce('price', 'product__price'),
+                                     output_field=models.FloatField()), 0.0),
+            total_quantity=Coalesce(Sum('quantity'), 0)
+        )
+
+    @cached_property
+    def cart_totals(self):
+        # one aggregate query, kept on the instance for the rest of the request
+        return self.calculate_cart_totals()
 
     @property
     def get_cart_total_price(self):
-        order_products = self.orderproduct_set.all()
-        total_price = sum([product.get_total_price for product in order_products])
-        return total_price
+        return self.cart_totals['total_price']
 
     @property
     def get_cart_total_quantity(self):
-        order_products = self.orderproduct_set.all()
-        total_price = sum([product.quantity for product in order_products])
-        return total_price
+        return self.cart_totals['total_quantity']
 
 
 class OrderProduct(models.Model):
@@ -162,17 +242,34 @@ class OrderProduct(models.Model):
     order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True)
     quantity = models.IntegerField(default=0, null=True, blank=True, verbose_name='Кол-во')
     added_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата добавления')
+    price = models.FloatField(null=True, blank=True, verbose_name='Цена на момент покупки')
+    title = models.CharField(max_length=250, blank=True, default='', verbose_name='Название на момент покупки')
+    image_url = models.CharField(max_length=500, blank=True, default='', verbose_name='Картинка на момент покупки')
 
     def __str__(self):
-        return f'{self.product.title} {self.order}'
+        return f'{self.get_title} {self.order}'
+
+    # a line with a snapshot never reads the catalog, its product may be changed or gone by now
+    @property
+    def get_title(self):
+        return self.title if self.price is not None else self.product.title
+
+    @property
+    def get_image_url(self):
+        return (self.image_url or '-') if self.price is not None else self.product.get_image_product()
 
     class Meta:
         verbose_name = 'Заказанный товар'
         verbose_name_plural = 'Заказанный товары'
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'product'], name='unique_order_product'),
+        ]
 
     @property
     def get_total_price(self):
-        total_price = self.product.price * self.quantity
+        # a paid line keeps the price it was bought for
+        price = self.price if self.price is not None else self.product.price
+        total_price = price * self.quantity
         return total_price
 
 
@@ -203,3 +300,18 @@ class City(models.Model):
     class Meta:
         verbose_name = 'Город'
         verbose_name_plural = 'Города'
+
+
+class PaymentEvent(models.Model):
+    event_id = models.CharField(max_length=255, unique=True, verbose_name='ID события')
+    type = models.CharField(max_length=255, verbose_name='Тип события')
+    payload = models.JSONField(verbose_name='Данные')
+    received_at = models.DateTimeField(auto_now_add=True, verbose_name='Получено')
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True, verbose_name='Обработано')
+
+    def __str__(self):
+        return f'{self.type} {self.event_id}'
+
+    class Meta:
+        verbose_name = 'Платёжное событие'
+        verbose_name_plural = 'Платёжные события'
@@ -0,0 +1,116 @@
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+CURSOR_SALT = 'digital.pagination'
+# below this many rows COUNT(*) is cheap enough to be exact
+ESTIMATE_THRESHOLD = 10000
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+# pages by "everything after the last row seen", so page 100 costs the same indexed range scan as page 1;
+# the last ordering field must be unique (pk)
+class KeysetPaginator:
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset.order_by(*ordering)
+        self.ordering = ordering
+        self.per_page = per_page
+
+    def _fields(self):
+        return [(field.lstrip('-'), field.startswith('-')) for field in self.ordering]
+
+    def _after(self, values):
+        fields = self._fields()
+        condition = Q()
+        for i, (name, descending) in enumerate(fields):
+            lookup = 'lt' if descending else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[i]})
+            for (previous, _), value in zip(fields[:i], values):
+                step &= Q(**{previous: value})
+            condition |= step
+        if len(fields) > 1:
+            # the OR alone is no range for the planner, the redundant bound on the first field lets an index
+            # like (category_id, created_at) seek instead of scanning
+            name, descending = fields[0]
+            condition &= Q(**{f'{name}__{"lte" if descending else "gte"}': values[0]})
+        return condition
+
+    def encode(self, obj):
+        values = [getattr(obj, name) for name, _ in self._fields()]
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+        # the ordering is signed too, a cursor only continues the list it came from
+        return signing.dumps({'ordering': list(self.ordering), 'values': values}, salt=CURSOR_SALT)
+
+    def decode(self, cursor):
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None
+        if not isinstance(data, dict) or data.get('ordering') != list(self.ordering):
+            return None
+        values = data.get('values')
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            return None
+        return values
+
+    def page(self, cursor=None):
+        queryset = self.queryset
+        values = self.decode(cursor) if cursor else None
+        if values is not None:
+            queryset = queryset.filter(self._after(values))
+
+        object_list = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            next_cursor = self.encode(object_list[-1])
+        return KeysetPage(object_list, next_cursor)
+
+
+def estimate_count(model):
+    # the row count the planner keeps for the table, None when there is none
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'sqlite':
+            # sqlite_stat1 only exists after ANALYZE
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(str(row[0]).split()[0])
+
+
+# a list of the whole table takes the estimate instead of scanning it with COUNT(*), filtered lists count exactly
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_count(self.object_list.model)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import math
+import time
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction, IntegrityError
+from django.db.models import OuterRef, Subquery, Sum, F, Value
+from django.db.models.functions import Coalesce, Concat
+from django.utils import timezone
+
+from .models import Order, OrderProduct, Product, PaymentEvent
+
+logger = logging.getLogger(__name__)
+
+PAID_EVENT_TYPES = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+CHECKOUT_CURRENCY = 'usd'
+# Stripe accepts a session lifetime from 30 minutes to 24 hours
+STRIPE_SESSION_MINUTES = (30, 23 * 60)
+# expiry times are rounded up to this grid, a resubmitted checkout sends the same parameters under the same key
+CHECKOUT_EXPIRY_STEP = 10 * 60
+
+_client = {'configured': False}
+
+
+def configure_stripe():
+    # one RequestsClient keeps a pooled requests.Session per worker thread instead of a new connection per payment
+    if not _client['configured']:
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+        stripe.default_http_client = stripe.http_client.RequestsClient(timeout=settings.STRIPE_TIMEOUT)
+        if settings.STRIPE_API_BASE:
+            stripe.api_base = settings.STRIPE_API_BASE
+        _client['configured'] = True
+
+
+def reset_stripe():
+    _client['configured'] = False
+
+
+def checkout_idempotency_key(order, lines, total_price, expires_at):
+    # the same cart always maps to the same key, so a double submit or a retry can't create two sessions
+    content = ';'.join(f'{product_id}:{quantity}' for product_id, quantity in sorted(lines))
+    digest = hashlib.sha256(f'{content}|{total_price}|{expires_at}'.encode()).hexdigest()[:32]
+    return f'checkout-{order.pk}-{digest}'
+
+
+def _session_lifetime():
+    # the session ends together with the reservation of the cart, as far as Stripe allows
+    low, high = STRIPE_SESSION_MINUTES
+    return min(max(settings.CART_RESERVATION_MINUTES, low), high) * 60
+
+
+def checkout_expires_at(now=None):
+    now = time.time() if now is None else now
+    return math.ceil((now + _session_lifetime()) / CHECKOUT_EXPIRY_STEP) * CHECKOUT_EXPIRY_STEP
+
+
+def checkout_hold_minutes():
+    # the longest a started checkout keeps its stock: its session may still be paid until it expires,
+    # and the payment gets one more reservation window to be processed
+    return math.ceil((_session_lifetime() + CHECKOUT_EXPIRY_STEP) / 60) + settings.CART_RESERVATION_MINUTES
+
+
+def start_checkout(order):
+    # the reservation is renewed for as long as the Stripe session lives, the lines keep the prices being charged
+    OrderProduct.objects.filter(order=order).update(added_at=timezone.now())
+    snapshot_orders([order.pk])
+
+
+def clear_snapshots(orders):
+    # an order that left checkout has no snapshot and no total, finalize_orders refuses a payment for it
+    OrderProduct.objects.filter(order__in=orders).update(price=None, title='', image_url='')
+    orders.update(total_price=None, checkout_session_id='')
+
+
+def remember_checkout_session(order, session_id):
+    Order.objects.filter(pk=order.pk).update(checkout_session_id=session_id)
+
+
+def cancel_checkout(order):
+    # the session is expired before the cart can change again, a paid one keeps the order as it was charged
+    if order.checkout_session_id:
+        configure_stripe()
+        try:
+            session = stripe.checkout.Session.expire(order.checkout_session_id)
+        except stripe.error.InvalidRequestError:
+            # only an open session can be expired, this one is expired already or paid
+            try:
+                session = stripe.checkout.Session.retrieve(order.checkout_session_id)
+            except stripe.error.StripeError:
+                return False
+        except stripe.error.StripeError:
+            return False
+        if session.status != 'expired':
+            return False
+    clear_snapshots(Order.objects.filter(pk=order.pk))
+    order.total_price, order.checkout_session_id = None, ''
+    return True
+
+
+def create_checkout_session(order, total_price, idempotency_key, expires_at, success_url, cancel_url):
+    configure_stripe()
+    return stripe.checkout.Session.create(
+        line_items=[{
+            'price_data': {
+                'currency': CHECKOUT_CURRENCY,
+                'product_data': {
+                    'name': 'DigitalStore товары'
+                },
+                'unit_amount': int(total_price)
+            },
+            'quantity': 1
+        }],
+        mode='payment',
+        client_reference_id=str(order.pk),
+        metadata={'order_id': order.pk},
+        expires_at=expires_at,
+        success_url=success_url,
+        cancel_url=cancel_url,
+        idempotency_key=idempotency_key
+    )
+
+
+# the Stripe call runs in the thread pool, an async worker keeps serving other requests while it waits
+acreate_checkout_session = sync_to_async(create_checkout_session, thread_sensitive=False)
+
+
+def record_payment_event(payload, signature):
+    # raises ValueError or stripe.error.SignatureVerificationError for anything not signed by Stripe
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        # an empty key would accept events signed by anyone
+        raise ImproperlyConfigured('STRIPE_WEBHOOK_SECRET is not set')
+    event = stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+    try:
+        with transaction.atomic():
+            PaymentEvent.objects.create(event_id=event['id'], type=event['type'], payload=event.to_dict_recursive())
+    except IntegrityError:
+        # Stripe delivers at least once, a repeated event is already queued
+        pass
+
+
+def _paid_session(event):
+    # order id, charged amount in cents and currency of a paid checkout session
+    if event.type not in PAID_EVENT_TYPES:
+        return None
+    session = event.payload.get('data', {}).get('object', {})
+    if session.get('payment_status') != 'paid':
+        return None
+    order_id = (session.get('metadata') or {}).get('order_id') or session.get('client_reference_id')
+    try:
+        return int(order_id), int(session.get('amount_total')), session.get('currency')
+    except (TypeError, ValueError):
+        return None
+
+
+def snapshot_orders(order_ids):
+    # copies price, title and first picture of every line, so a paid order never has to read the catalog again
+    lines = OrderProduct.objects.filter(order_id__in=order_ids, product__isnull=False)
+    product = Product.objects.filter(pk=OuterRef('product_id'))
+    first_image = product.values('primary_image__image')[:1]
+    lines.update(
+        price=Subquery(product.values('price')[:1]),
+        title=Subquery(product.values('title')[:1]),
+        image_url=Coalesce(Concat(Value(settings.MEDIA_URL), Subquery(first_image)), Value(''))
+    )
+
+    order_total = (OrderProduct.objects.filter(order=OuterRef('pk')).order_by().values('order')
+                   .annotate(total=Sum(F('quantity') * F('price'))).values('total'))
+    Order.objects.filter(pk__in=order_ids).update(total_price=Coalesce(Subquery(order_total), 0.0))
+
+
+def finalize_orders(paid):
+    # paid holds (order id, amount, currency) of every paid session, an order is completed only for what it costs
+    totals = dict(Order.objects.filter(pk__in=[order_id for order_id, _, _ in paid], is_completed=False)
+                  .values_list('pk', 'total_price'))
+    order_ids = []
+    for order_id, amount, currency in paid:
+        if order_id not in totals:
+            continue
+        if totals[order_id] is None or int(totals[order_id]) != amount or currency != CHECKOUT_CURRENCY:
+            logger.warning('Order %s was paid %s %s instead of %s %s', order_id, amount, currency,
+                           totals[order_id], CHECKOUT_CURRENCY)
+            continue
+        order_ids.append(order_id)
+    # the stock was taken when the items went into the cart and the lines were snapshotted at checkout,
+    # a cart changed since then has no total and never gets here
+    return Order.objects.filter(pk__in=order_ids).update(is_completed=True)
+
+
+def process_payment_events(batch_size=100):
+    processed = 0
+    pending = PaymentEvent.objects.filter(processed_at__isnull=True).order_by('pk')
+    while True:
+        events = list(pending[:batch_size])
+        if not events:
+            return processed
+        paid = {session for session in map(_paid_session, events) if session}
+        with transaction.atomic():
+            finalize_orders(paid)
+            PaymentEvent.objects.filter(pk__in=[event.pk for event in events]).update(processed_at=timezone.now())
+        processed += len(events)
@@ -0,0 +1,160 @@
+import random
+import time
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Max, Q, F
+from django.utils import timezone
+
+from .models import Product, ProductDescription, OrderProduct, RelatedProduct
+
+RECOMMENDATIONS_LIMIT = 8
+POOL_TIMEOUT = 300
+
+RELATED_LIMIT = 12
+# groups bigger than this (a huge category, a common parameter) only contribute their newest members
+MAX_GROUP_SIZE = 500
+CATEGORY_WEIGHT = 3
+BRAND_WEIGHT = 2
+PARAMETER_WEIGHT = 1
+ORDER_WEIGHT = 2
+
+# the pool is replaced as a whole and never changed in place, a request keeps the one it read
+_pool = {'value': None}
+
+
+def get_product_pool():
+    # ids of the whole catalog grouped by category and brand, rebuilt at most every POOL_TIMEOUT seconds
+    pool = _pool['value']
+    if pool is None or time.monotonic() - pool['built_at'] > POOL_TIMEOUT:
+        all_ids, by_category, by_brand = [], {}, {}
+        for pk, category_id, brand_id in Product.objects.values_list('pk', 'category_id', 'brand_id'):
+            all_ids.append(pk)
+            by_category.setdefault(category_id, []).append(pk)
+            if brand_id:
+                by_brand.setdefault(brand_id, []).append(pk)
+
+        pool = {'all': all_ids, 'category': by_category, 'brand': by_brand, 'built_at': time.monotonic()}
+        _pool['value'] = pool
+    return pool
+
+
+def clear_product_pool():
+    _pool['value'] = None
+
+
+def _sample(ids, count, exclude):
+    # sampling a few extra ids keeps the pick bounded instead of filtering the whole list
+    candidates = random.sample(ids, min(len(ids), count + len(exclude)))
+    return [pk for pk in candidates if pk not in exclude][:count]
+
+
+def get_recommended_products(product, limit=RECOMMENDATIONS_LIMIT):
+    ids = list(RelatedProduct.objects.filter(product=product).values_list('related_id', flat=True)[:limit])
+    if len(ids) < limit:
+        ids += get_random_product_ids(product, limit - len(ids), exclude=ids)
+
+    products = Product.objects.filter(pk__in=ids).select_related('primary_image').in_bulk()
+    return [products[pk] for pk in ids if pk in products]
+
+
+def get_random_product_ids(product, limit, exclude=()):
+    pool = get_product_pool()
+    picked = {product.pk, *exclude}
+    ids = []
+
+    for group in (pool['category'].get(product.category_id, []), pool['brand'].get(product.brand_id, []),
+                  pool['all']):
+        if len(ids) >= limit:
+            break
+        for pk in _sample(group, limit - len(ids), picked):
+            picked.add(pk)
+            ids.append(pk)
+    return ids
+
+
+def _group(pairs):
+    groups = defaultdict(list)
+    for key, pk in pairs:
+        if len(groups[key]) < MAX_GROUP_SIZE:
+            groups[key].append(pk)
+    return groups
+
+
+def _load_signals():
+    products = Product.objects.order_by('-created_at').values_list('pk', 'category_id', 'brand_id')
+    product_keys = {pk: (category_id, brand_id) for pk, category_id, brand_id in products}
+    categories = _group((category_id, pk) for pk, (category_id, brand_id) in product_keys.items())
+    brands = _group((brand_id, pk) for pk, (category_id, brand_id) in product_keys.items() if brand_id)
+
+    product_parameters = defaultdict(set)
+    for pk, parameter, info in ProductDescription.objects.values_list('product_id', 'parameter', 'parameter_info'):
+        product_parameters[pk].add((parameter, info))
+    parameters = _group((key, pk) for pk, keys in product_parameters.items() for key in keys)
+
+    order_lines = OrderProduct.objects.filter(order__isnull=False, product__isnull=False)
+    product_orders = defaultdict(set)
+    for order_id, pk in order_lines.values_list('order_id', 'product_id'):
+        product_orders[pk].add(order_id)
+    orders = _group((order_id, pk) for pk, order_ids in product_orders.items() for order_id in order_ids)
+
+    return {
+        'products': product_keys,
+        'categories': categories,
+        'brands': brands,
+        'product_parameters': product_parameters,
+        'parameters': parameters,
+        'product_orders': product_orders,
+        'orders': orders,
+    }
+
+
+def score_related_products(pk, signals, limit=RELATED_LIMIT):
+    category_id, brand_id = signals['products'][pk]
+    scores = Counter()
+
+    for related in signals['categories'].get(category_id, []):
+        scores[related] += CATEGORY_WEIGHT
+    for related in signals['brands'].get(brand_id, []):
+        scores[related] += BRAND_WEIGHT
+    for key in signals['product_parameters'].get(pk, []):
+        for related in signals['parameters'][key]:
+            scores[related] += PARAMETER_WEIGHT
+    for order_id in signals['product_orders'].get(pk, []):
+        for related in signals['orders'][order_id]:
+            scores[related] += ORDER_WEIGHT
+
+    scores.pop(pk, None)
+    return scores.most_common(limit)
+
+
+def get_stale_product_ids():
+    # products edited after their related list was computed, or never computed at all
+    stale = Product.objects.annotate(computed_at=Max('related_products__computed_at')).filter(
+        Q(computed_at__isnull=True) | Q(edited_at__gt=F('computed_at'))
+    )
+    stale_ids = set(stale.values_list('pk', flat=True))
+    # lists that point to a changed product may have to change as well
+    stale_ids.update(RelatedProduct.objects.filter(related_id__in=stale_ids).values_list('product_id', flat=True))
+    return stale_ids
+
+
+def refresh_related_products(product_ids=None, batch_size=1000):
+    signals = _load_signals()
+    if product_ids is None:
+        product_ids = signals['products'].keys()
+    product_ids = [pk for pk in product_ids if pk in signals['products']]
+
+    for start in range(0, len(product_ids), batch_size):
+        batch = product_ids[start:start + batch_size]
+        computed_at = timezone.now()
+        rows = [
+            RelatedProduct(product_id=pk, related_id=related, score=score, computed_at=computed_at)
+            for pk in batch
+            for related, score in score_related_products(pk, signals)
+        ]
+        with transaction.atomic():
+            RelatedProduct.objects.filter(product_id__in=batch).delete()
+            RelatedProduct.objects.bulk_create(rows)
+
+    return len(product_ids)
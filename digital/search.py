@@ -0,0 +1,124 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+SEARCH_TABLE = 'digital_product_search'
+# weights for title, description, brand and parameters columns in bm25()
+SEARCH_WEIGHTS = (10.0, 1.0, 4.0, 2.0)
+RUSSIAN_ENDINGS = 'аеиоуыэюяьй'
+
+INDEX_SQL = f'''
+    INSERT INTO {SEARCH_TABLE}(rowid, title, description, brand, parameters)
+    SELECT p.id, p.title, COALESCE(p.description_all, ''), COALESCE(b.title, ''),
+           COALESCE((SELECT group_concat(d.parameter || ' ' || d.parameter_info, ' ')
+                     FROM digital_productdescription d WHERE d.product_id = p.id), '')
+    FROM digital_product p
+    LEFT JOIN digital_brand b ON b.id = p.brand_id
+'''
+
+
+def is_supported():
+    return connection.vendor == 'sqlite'
+
+
+def _in_clause(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+def index_products(product_ids):
+    product_ids = list(product_ids)
+    if not product_ids or not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({_in_clause(product_ids)})', product_ids)
+        cursor.execute(f'{INDEX_SQL} WHERE p.id IN ({_in_clause(product_ids)})', product_ids)
+
+
+def remove_products(product_ids):
+    product_ids = list(product_ids)
+    if not product_ids or not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({_in_clause(product_ids)})', product_ids)
+
+
+def rebuild_index():
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(INDEX_SQL)
+
+
+def filter_products(queryset, text):
+    match = build_match_query(text)
+    if not match:
+        return queryset.none()
+    return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s',
+                                         [match]))
+
+
+def _stem(word):
+    # a crude stem so that "диваны" still finds "диван"
+    if len(word) > 4 and word[-1] in RUSSIAN_ENDINGS:
+        return word[:-1]
+    return word
+
+
+def build_match_query(text):
+    words = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{_stem(word)}"*' for word in words)
+
+
+# ranked search results that load only the requested page, so the list can be handed to Paginator
+class SearchResultsList:
+    def __init__(self, text):
+        self.match = build_match_query(text or '')
+        self.fallback = None
+        if self.match and not is_supported():
+            self.fallback = Product.objects.filter(
+                Q(title__icontains=text) | Q(description_all__icontains=text) | Q(brand__title__icontains=text)
+            ).select_related('primary_image').order_by('-created_at')
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if not self.match:
+                self._count = 0
+            elif self.fallback is not None:
+                self._count = self.fallback.count()
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'SELECT count(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s',
+                                   [self.match])
+                    self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        if not self.match:
+            return []
+        if self.fallback is not None:
+            return list(self.fallback[item])
+
+        start = item.start or 0
+        stop = item.stop if item.stop is not None else self.count()
+        weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+                f'ORDER BY bm25({SEARCH_TABLE}, {weights}) LIMIT %s OFFSET %s',
+                [self.match, max(stop - start, 0), start]
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+
+        products = Product.objects.filter(pk__in=ids).select_related('primary_image').in_bulk()
+        return [products[pk] for pk in ids if pk in products]
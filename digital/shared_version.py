@@ -0,0 +1,21 @@
+import time
+
+from django.core.cache import cache
+
+
+# for data every worker keeps a copy of: a change bumps the version in the default cache and the other
+# workers rebuild their copy, the timeout covers a default cache that isn't shared between them
+class SharedVersion:
+    def __init__(self, key, timeout):
+        self.key = key
+        self.timeout = timeout
+
+    def current(self):
+        # a version that fell out of the cache comes back as a new one
+        return cache.get_or_set(self.key, time.time_ns, None)
+
+    def bump(self):
+        cache.set(self.key, time.time_ns(), None)
+
+    def is_current(self, built_version, built_at, version):
+        return built_version == version and time.monotonic() - built_at <= self.timeout
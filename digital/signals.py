@@ -0,0 +1,81 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import category_tree, images, search, suggestions
+from .models import Category, Product, Brand, ProductDescription, Gallery
+from .recommendations import clear_product_pool
+from .utils import merge_session_cart, refresh_primary_images
+
+
+@receiver([post_save, post_delete], sender=Product)
+def reset_product_pool(sender, **kwargs):
+    clear_product_pool()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_index(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=ProductDescription)
+def index_product_parameters(sender, instance, **kwargs):
+    search.index_products([instance.product_id])
+
+
+@receiver(post_save, sender=Brand)
+def index_brand_products(sender, instance, **kwargs):
+    search.index_products(instance.product_set.values_list('pk', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Brand)
+def reset_suggestions(sender, **kwargs):
+    suggestions.clear()
+
+
+@receiver([post_save, post_delete], sender=Category)
+def reset_category_tree(sender, **kwargs):
+    category_tree.clear()
+
+
+@receiver(pre_save, sender=Gallery)
+def mark_uploaded_image(sender, instance, **kwargs):
+    # a file assigned by name is left to the generate_image_variants command, only uploads are processed here
+    instance._image_uploaded = bool(instance.image) and not instance.image._committed
+
+
+@receiver(post_save, sender=Gallery)
+def make_image_variants(sender, instance, **kwargs):
+    if not getattr(instance, '_image_uploaded', False):
+        return
+    instance._image_uploaded = False
+    previous = instance.variants.get('source')
+    if previous != instance.image.name and not Gallery.objects.filter(image=previous).exists():
+        images.delete_variants(instance.variants)
+    instance.variants = images.build_variants(instance.image.name, instance.image.storage)
+    Gallery.objects.filter(pk=instance.pk).update(variants=instance.variants)
+
+
+@receiver(post_delete, sender=Gallery)
+def delete_image_variants(sender, instance, **kwargs):
+    # identical uploads share one file and its copies
+    if not Gallery.objects.filter(image=instance.image.name).exists():
+        images.delete_variants(instance.variants)
+
+
+@receiver([post_save, post_delete], sender=Gallery)
+def refresh_primary_image(sender, instance, **kwargs):
+    # a new picture changes the product card, bumping edited_at retires its cached fragment
+    refresh_primary_images([instance.product_id])
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request)
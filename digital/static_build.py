@@ -0,0 +1,242 @@
+import gzip
+import logging
+import posixpath
+import re
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.finders import FileSystemFinder
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_TAG = re.compile(r'''{%\s*static\s+['"]([^'"]+)['"]''')
+TEMPLATE_TAG = re.compile(r'''{%\s*(?:extends|include)\s+['"]([^'"]+)['"]''')
+CSS_REFERENCE = re.compile(r'''url\(\s*['"]?([^'")]+?)['"]?\s*\)|@import\s+['"]([^'"]+)['"]''')
+FONT_FACE = re.compile(r'@font-face\s*{[^}]*}')
+CSS_CONTENT_RULE = re.compile(r'''([^{}]+){[^{}]*?content:\s*['"]\\([0-9a-fA-F]{4,6})['"]''')
+ICON_CLASS = re.compile(r'\bfa-[a-z0-9-]+')
+
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2')
+FONT_FORMATS = ('.woff2', '.woff', '.ttf', '.otf', '.eot', '.svg')
+# icon fonts keep only the glyphs the templates use, text fonts keep Latin, Cyrillic and punctuation
+ICON_FONT_PREFIX = 'fa-'
+TEXT_UNICODES = [*range(0x20, 0x7f), *range(0xa0, 0x180), *range(0x400, 0x530), *range(0x2000, 0x2070), 0x20bd]
+
+
+def _template_dirs():
+    return [Path(directory) for directory in settings.TEMPLATES[0]['DIRS']] + [
+        Path(apps.get_app_config('digital').path) / 'templates']
+
+
+def _project_static_dirs():
+    return [Path(directory) for directory in settings.STATICFILES_DIRS]
+
+
+def _read_static(path):
+    source = finders.find(path)
+    return Path(source).read_text(encoding='utf-8', errors='ignore') if source else ''
+
+
+def _resolve(css_path, url):
+    if url.startswith(('data:', 'http:', 'https:', '//', '#', '/')):
+        return None
+    url = url.split('?')[0].split('#')[0]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(css_path), url)) if url else None
+
+
+def _font_rank(font):
+    extension = posixpath.splitext(font)[1]
+    return FONT_FORMATS.index(extension) if extension in FONT_FORMATS else len(FONT_FORMATS)
+
+
+def _css_assets(path, required, downloaded, seen):
+    # required is everything the manifest storage has to find, downloaded is what a browser actually fetches:
+    # of every @font-face only the first format in FONT_FORMATS order
+    if path in seen:
+        return
+    seen.add(path)
+    css = _read_static(path)
+    font_faces = FONT_FACE.findall(css)
+    for font_face in font_faces:
+        fonts = [_resolve(path, match[0]) for match in CSS_REFERENCE.findall(font_face) if match[0]]
+        fonts = [font for font in fonts if font]
+        if fonts:
+            downloaded.add(min(fonts, key=_font_rank))
+
+    for url, imported in CSS_REFERENCE.findall(css):
+        asset = _resolve(path, url or imported)
+        if asset is None:
+            continue
+        required.add(asset)
+        if asset.endswith('.css'):
+            downloaded.add(asset)
+            _css_assets(asset, required, downloaded, seen)
+        elif not asset.endswith(FONT_FORMATS):
+            downloaded.add(asset)
+
+
+def _templates():
+    templates = {}
+    for directory in _template_dirs():
+        for file in directory.rglob('*.html'):
+            templates.setdefault(file.relative_to(directory).as_posix(), file.read_text(encoding='utf-8'))
+    return templates
+
+
+def _template_assets(name, templates, cache):
+    if name not in cache:
+        cache[name] = set()
+        source = templates.get(name, '')
+        assets = set(STATIC_TAG.findall(source))
+        for child in TEMPLATE_TAG.findall(source):
+            assets |= _template_assets(child, templates, cache)
+        cache[name] = assets
+    return cache[name]
+
+
+def _expand(assets):
+    required, downloaded, seen = set(assets), set(assets), set()
+    for asset in assets:
+        if asset.endswith('.css'):
+            _css_assets(asset, required, downloaded, seen)
+    return required, downloaded
+
+
+def find_page_assets():
+    # a page is a template that no other template extends or includes, partials start with an underscore
+    templates = _templates()
+    children = {child for source in templates.values() for child in TEMPLATE_TAG.findall(source)}
+    cache = {}
+    return {name: sorted(_expand(_template_assets(name, templates, cache))[1])
+            for name in sorted(templates) if name not in children and not posixpath.basename(name).startswith('_')}
+
+
+def find_used_assets():
+    templates = _templates()
+    assets = set()
+    for source in templates.values():
+        assets |= set(STATIC_TAG.findall(source))
+    return _expand(assets)[0]
+
+
+def find_unused_assets():
+    # only files of the project itself are pruned, apps like admin and jazzmin reference theirs dynamically
+    used = find_used_assets()
+    finder = FileSystemFinder()
+    return sorted({path for path, storage in finder.list([]) if path not in used})
+
+
+def find_used_codepoints():
+    used_classes = set()
+    for source in _templates().values():
+        used_classes |= set(ICON_CLASS.findall(source))
+    for directory in _project_static_dirs():
+        for script in directory.rglob('*.js'):
+            used_classes |= set(ICON_CLASS.findall(script.read_text(encoding='utf-8', errors='ignore')))
+
+    codepoints = set()
+    for asset in find_used_assets():
+        if not asset.endswith('.css'):
+            continue
+        for selectors, codepoint in CSS_CONTENT_RULE.findall(_read_static(asset)):
+            icons = ICON_CLASS.findall(selectors)
+            # a rule of icon classes only counts when one of them is used, any other rule always does
+            if not icons or used_classes.intersection(icons):
+                codepoints.add(int(codepoint, 16))
+    return codepoints
+
+
+def subset_fonts(storage, paths):
+    try:
+        from fontTools import subset
+    except ImportError:
+        logger.warning('fonttools is not installed, fonts are collected without subsetting')
+        return []
+
+    icon_codepoints = None
+    results = []
+    for path in paths:
+        if not path.endswith(FONT_EXTENSIONS):
+            continue
+        name = posixpath.basename(path)
+        if name.startswith(ICON_FONT_PREFIX):
+            if icon_codepoints is None:
+                icon_codepoints = find_used_codepoints()
+            unicodes = icon_codepoints
+        else:
+            unicodes = TEXT_UNICODES
+
+        file = storage.path(path)
+        before = Path(file).stat().st_size
+        options = subset.Options()
+        options.flavor = {'.woff': 'woff', '.woff2': 'woff2'}.get(posixpath.splitext(name)[1])
+        options.layout_features = ['*']
+        try:
+            font = subset.load_font(file, options)
+            subsetter = subset.Subsetter(options)
+            subsetter.populate(unicodes=unicodes)
+            subsetter.subset(font)
+            subset.save_font(font, file, options)
+        except Exception as error:
+            # woff2 needs brotli, an odd font must not break the whole build
+            logger.warning('Font %s was not subset: %s', path, error)
+            continue
+        results.append((path, before, Path(file).stat().st_size))
+    return results
+
+
+def _transfer_sizes(data):
+    sizes = {'raw': len(data), 'gzip': len(gzip.compress(data, 9))}
+    if brotli is not None:
+        sizes['brotli'] = len(brotli.compress(data))
+    return sizes
+
+
+def budget_report(pages, budget_kb=None):
+    budget = (settings.STATIC_BUDGET_KB if budget_kb is None else budget_kb) * 1024
+    sizes = {}
+    report = {}
+    for page, assets in pages.items():
+        total_raw = total_transfer = 0
+        for asset in assets:
+            if asset not in sizes:
+                # the collected copy is the subset one, the source is measured before the first build
+                collected = Path(settings.STATIC_ROOT) / asset
+                source = collected if collected.is_file() else finders.find(asset)
+                sizes[asset] = _transfer_sizes(Path(source).read_bytes()) if source else None
+            if sizes[asset] is None:
+                continue
+            total_raw += sizes[asset]['raw']
+            total_transfer += min(sizes[asset].values())
+        report[page] = {
+            'assets': {asset: sizes[asset] for asset in assets},
+            'raw': total_raw,
+            'transfer': total_transfer,
+            'budget': budget,
+            'over_budget': total_transfer > budget,
+        }
+    return report
+
+
+# collectstatic with this storage subsets the collected fonts before whitenoise hashes and compresses them
+class BuildStaticFilesStorage(CompressedManifestStaticFilesStorage):
+    # vendored css/js point at source maps that are not shipped, only real url() and imports are rewritten
+    patterns = tuple((extension, tuple(pattern for pattern in extension_patterns
+                                       if 'sourceMappingURL' not in str(pattern)))
+                     for extension, extension_patterns in CompressedManifestStaticFilesStorage.patterns)
+
+    def post_process(self, paths, *args, **kwargs):
+        if not kwargs.get('dry_run'):
+            project_paths = [path for path, (storage, source) in paths.items()
+                             if any(Path(storage.path(source)).is_relative_to(directory)
+                                    for directory in _project_static_dirs())]
+            subset_fonts(self, project_paths)
+        yield from super().post_process(paths, *args, **kwargs)
@@ -0,0 +1,112 @@
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlencode
+
+from django.db import DatabaseError, connection
+from django.urls import reverse
+
+from .models import Product, Brand
+from .shared_version import SharedVersion
+
+SUGGESTIONS_LIMIT = 8
+INDEX_VERSION = SharedVersion('suggestions:version', timeout=300)
+
+_lock = threading.Lock()
+# generation counts the changes seen by this worker, built is the generation the index was built for
+_index = {'keys': None, 'items': None, 'generation': 0, 'built': None, 'version': None, 'built_at': 0,
+          'rebuild': None, 'rebuilding': False}
+
+
+def normalize(text):
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+
+def _entries():
+    for title, slug in Product.objects.exclude(slug=None).values_list('title', 'slug'):
+        yield title, reverse('product_detail', kwargs={'slug': slug})
+    search_url = reverse('search')
+    for title in Brand.objects.values_list('title', flat=True).distinct():
+        yield title, f'{search_url}?{urlencode({"q": title})}'
+
+
+def build_index():
+    rows = []
+    for title, url in _entries():
+        words = normalize(title).split(' ')
+        # every word start is a key, so "угловой" finds "Диван угловой"
+        for i in range(len(words)):
+            rows.append((' '.join(words[i:]), title, url))
+    rows.sort()
+    return [row[0] for row in rows], [(row[1], row[2]) for row in rows]
+
+
+def warm():
+    version = INDEX_VERSION.current()
+    with _lock:
+        generation = _index['generation']
+    keys, items = build_index()
+    with _lock:
+        # an index started before a clear() keeps its old generation, so the change is not lost
+        # and the next keystroke rebuilds it again
+        if _index['built'] is None or generation >= _index['built']:
+            _index.update(keys=keys, items=items, built=generation, version=version, built_at=time.monotonic())
+
+
+def _rebuild():
+    try:
+        warm()
+    finally:
+        connection.close()
+        with _lock:
+            _index['rebuilding'] = False
+
+
+def warm_on_startup():
+    # the index is ready before the first keystroke; before the first migrate there is nothing to index,
+    # and the first keystroke builds it instead
+    try:
+        warm()
+    except DatabaseError:
+        pass
+
+
+def clear():
+    with _lock:
+        _index['generation'] += 1
+    INDEX_VERSION.bump()
+
+
+def _is_stale(version):
+    return (_index['built'] != _index['generation']
+            or not INDEX_VERSION.is_current(_index['version'], _index['built_at'], version))
+
+
+def suggest(text, limit=SUGGESTIONS_LIMIT):
+    prefix = normalize(text)
+    if not prefix:
+        return []
+
+    version = INDEX_VERSION.current()
+    with _lock:
+        keys, items = _index['keys'], _index['items']
+        # a stale index keeps answering while a thread builds the new one, no keystroke waits for it
+        if keys is not None and not _index['rebuilding'] and _is_stale(version):
+            _index['rebuilding'] = True
+            _index['rebuild'] = threading.Thread(target=_rebuild, daemon=True)
+            _index['rebuild'].start()
+    if keys is None:
+        warm()
+        with _lock:
+            keys, items = _index['keys'], _index['items']
+
+    suggestions = []
+    seen = set()
+    position = bisect_left(keys, prefix)
+    while position < len(keys) and keys[position].startswith(prefix) and len(suggestions) < limit:
+        title, url = items[position]
+        if url not in seen:
+            seen.add(url)
+            suggestions.append({'title': title, 'url': url})
+        position += 1
+    return suggestions
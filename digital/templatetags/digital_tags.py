@@ -1,4 +1,5 @@
-from digital.models import Category, FavoriteProduct, OrderProduct
+from digital.category_tree import get_root_categories
+from digital.fragments import render_product_card
 from django import template
 
 register = template.Library()
@@ -6,15 +7,14 @@ register = template.Library()
 
 @register.simple_tag()
 def get_categories():
-    categories = Category.objects.filter(parent=None)
-    return categories
+    return get_root_categories()
 
 
-@register.simple_tag()
-def get_favorite_products(user):
-    favorite_products = FavoriteProduct.objects.filter(user=user)
-    products = [i.product for i in favorite_products]
-    return products
+@register.simple_tag(takes_context=True)
+def product_card(context, product):
+    request = context.get('request')
+    is_favorite = bool(request and request.user.is_authenticated and product.pk in context.get('favorite_ids', ()))
+    return render_product_card(product, is_favorite)
 
 
 @register.simple_tag()
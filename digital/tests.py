@@ -1,3 +1,1344 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest.mock import patch
+from urllib.parse import parse_qs
+
+import stripe
+from PIL import Image as PILImage
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.conf import settings
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.db.models import Sum
+from django.http import QueryDict
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase, RequestFactory, AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 
 # Create your tests here.
+from . import category_tree, fragments, images, media, payments, search, static_build, suggestions
+from .models import (Category, Brand, Product, Gallery, FavoriteProduct, ProductDescription, RelatedProduct,
+                     OrderProduct, Order, Customer, City, ShippingAdress, PaymentEvent, Profile)
+from .images import variant_name
+from .payments import process_payment_events
+from .utils import CartForAuthenticatedUser, CheckoutInProgress, release_expired_reservations, get_stock_metrics
+from .recommendations import (RECOMMENDATIONS_LIMIT, get_product_pool, get_recommended_products,
+                              get_stale_product_ids, refresh_related_products)
+
+TEST_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'fragments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fragments'},
+}
+
+
+def create_product(category, number, **kwargs):
+    kwargs.setdefault('title', f'Товар {number}')
+    product = Product.objects.create(price=1000 + number, quantity=10, slug=f'product-{category.pk}-{number}',
+                                     category=category, **kwargs)
+    Gallery.objects.create(product=product, image=f'products/{number}.png')
+    return product
+
+
+def make_cart(user):
+    request = RequestFactory().get('/')
+    request.user = user
+    request.session = {}
+    return CartForAuthenticatedUser(request)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class ProductListTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.categories = [Category.objects.create(title=f'Категория {i}', slug=f'category-{i}') for i in range(3)]
+        category_tree.get_tree()
+
+    def add_products(self, count):
+        for category in self.categories:
+            for i in range(count):
+                product = create_product(category, Product.objects.count())
+                if i % 2:
+                    FavoriteProduct.objects.create(user=self.user, product=product)
+
+    def count_index_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_query_count_does_not_grow_with_catalog(self):
+        self.client.force_login(self.user)
+        self.add_products(2)
+        self.count_index_queries()
+        small, _ = self.count_index_queries()
+        self.add_products(20)
+        large, response = self.count_index_queries()
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.context['products']), 3 * 21)
+
+    def test_favorites_marked_in_grid(self):
+        self.client.force_login(self.user)
+        self.add_products(3)
+        _, response = self.count_index_queries()
+        self.assertContains(response, '❤️', count=FavoriteProduct.objects.count())
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class FavoriteProductTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(10)]
+        for product in self.products[::2]:
+            FavoriteProduct.objects.create(user=self.user, product=product)
+        self.client.force_login(self.user)
+
+    def test_category_page_loads_favorites_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('category_page', kwargs={'slug': self.category.slug}))
+        favorite_queries = [q for q in queries if 'digital_favoriteproduct' in q['sql']]
+        self.assertEqual(len(favorite_queries), 1)
+        self.assertContains(response, '❤️', count=5)
+
+    def test_save_favorite_product_toggles(self):
+        product = self.products[0]
+        self.client.get(reverse('add_favorite', kwargs={'slug': product.slug}))
+        self.assertFalse(FavoriteProduct.objects.filter(user=self.user, product=product).exists())
+        self.client.get(reverse('add_favorite', kwargs={'slug': product.slug}))
+        self.assertTrue(FavoriteProduct.objects.filter(user=self.user, product=product).exists())
+
+    def test_favorite_page_lists_products(self):
+        response = self.client.get(reverse('my_favorite'))
+        self.assertEqual(len(response.context['products']), 5)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class ProductDetailTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.other_category = Category.objects.create(title='Другая категория', slug='other-category')
+        self.product = create_product(self.category, 0)
+        category_tree.get_tree()
+
+    def count_detail_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.product.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_recommendations_are_bounded(self):
+        for i in range(1, 6):
+            create_product(self.other_category, i)
+        small, _ = self.count_detail_queries()
+        for i in range(6, 60):
+            create_product(self.other_category, i)
+        large, response = self.count_detail_queries()
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.context['products']), RECOMMENDATIONS_LIMIT)
+        self.assertNotIn(self.product, response.context['products'])
+
+    def test_same_category_comes_first(self):
+        related = [create_product(self.category, i) for i in range(1, 4)]
+        for i in range(4, 30):
+            create_product(self.other_category, i)
+        _, response = self.count_detail_queries()
+        self.assertCountEqual(response.context['products'][:3], related)
+
+
+class RelatedProductTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.other_category = Category.objects.create(title='Другая категория', slug='other-category')
+        self.product = create_product(self.category, 0)
+        self.same_category = create_product(self.category, 1)
+        self.same_parameter = create_product(self.other_category, 2)
+        self.unrelated = create_product(self.other_category, 3)
+        for product in (self.product, self.same_parameter):
+            ProductDescription.objects.create(product=product, parameter='Материал', parameter_info='Дуб')
+
+    def test_command_ranks_related_products(self):
+        call_command('refresh_related_products', stdout=StringIO())
+        related = list(RelatedProduct.objects.filter(product=self.product).values_list('related_id', flat=True))
+        self.assertEqual(related, [self.same_category.pk, self.same_parameter.pk])
+
+    def test_only_stale_products_are_refreshed(self):
+        refresh_related_products()
+        self.assertEqual(get_stale_product_ids(), set())
+        self.unrelated.title = 'Новое название'
+        self.unrelated.save()
+        self.assertIn(self.unrelated.pk, get_stale_product_ids())
+        self.assertNotIn(self.product.pk, get_stale_product_ids())
+
+    def test_recommendations_start_with_related(self):
+        refresh_related_products()
+        products = get_recommended_products(self.product)
+        self.assertEqual(products[:2], [self.same_category, self.same_parameter])
+        self.assertEqual(len(products), 3)
+
+    def test_pool_in_use_survives_a_save(self):
+        pool = get_product_pool()
+        self.unrelated.save()
+        self.assertEqual(pool['category'][self.category.pk], [self.product.pk, self.same_category.pk])
+        self.assertIsNot(get_product_pool(), pool)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class SearchResultsTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.brand = Brand.objects.create(title='Икеа')
+        self.sofa = create_product(self.category, 0, title='Диван угловой', brand=self.brand)
+        self.chair = create_product(self.category, 1, title='Стул', description_all='Подходит к дивану')
+        self.table = create_product(self.category, 2, title='Стол')
+        ProductDescription.objects.create(product=self.table, parameter='Материал', parameter_info='Дуб')
+
+    def search(self, q):
+        return self.client.get(reverse('search'), {'q': q}).context['products']
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(list(self.search('диваны')), [self.sofa, self.chair])
+
+    def test_prefix_brand_and_parameters(self):
+        self.assertEqual(list(self.search('ике')), [self.sofa])
+        self.assertEqual(list(self.search('дуб')), [self.table])
+
+    def test_index_follows_changes(self):
+        self.table.title = 'Стол письменный'
+        self.table.save()
+        self.assertEqual(list(self.search('письмен')), [self.table])
+        self.table.delete()
+        self.assertEqual(list(self.search('стол')), [])
+
+    def test_missing_query_and_special_characters(self):
+        self.assertEqual(self.client.get(reverse('search')).status_code, 200)
+        self.assertEqual(list(self.search('"(*')), [])
+
+    def test_results_are_paginated(self):
+        for i in range(3, 30):
+            create_product(self.category, i, title=f'Кресло {i}')
+        response = self.client.get(reverse('search'), {'q': 'кресло', 'page': 2})
+        self.assertEqual(response.context['paginator'].count, 27)
+        self.assertEqual(len(response.context['products']), 3)
+
+
+# the index is rebuilt in a thread, which only sees committed rows
+class SearchSuggestionsTest(TransactionTestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.sofa = create_product(self.category, 0, title='Диван угловой')
+        create_product(self.category, 1, title='Диванная подушка')
+        create_product(self.category, 2, title='Стол')
+        Brand.objects.create(title='Ёлка мебель')
+        suggestions.warm()
+
+    def suggest(self, q):
+        response = self.client.get(reverse('search_suggestions'), {'q': q})
+        return [item['title'] for item in response.json()['suggestions']]
+
+    def test_prefix_and_word_matches(self):
+        self.assertEqual(self.suggest('ДИВАН'), ['Диван угловой', 'Диванная подушка'])
+        self.assertEqual(self.suggest('угл'), ['Диван угловой'])
+        self.assertEqual(self.suggest('елка'), ['Ёлка мебель'])
+        self.assertEqual(self.suggest(''), [])
+
+    def test_no_queries_per_keystroke(self):
+        self.suggest('д')
+        with self.assertNumQueries(0):
+            self.suggest('ди')
+
+    def test_index_follows_product_changes(self):
+        self.suggest('д')
+        self.sofa.title = 'Кресло'
+        self.sofa.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('кре'), [])
+        suggestions._index['rebuild'].join()
+        self.assertEqual(self.suggest('кре'), ['Кресло'])
+
+    def test_index_follows_other_workers(self):
+        self.suggest('д')
+        # another worker saved the product, only the shared version tells this one
+        Product.objects.filter(pk=self.sofa.pk).update(title='Кресло')
+        caches['default'].set(suggestions.INDEX_VERSION.key, 'other')
+        self.suggest('кре')
+        suggestions._index['rebuild'].join()
+        self.assertEqual(self.suggest('кре'), ['Кресло'])
+
+    def test_startup_skips_a_missing_table(self):
+        with patch.object(suggestions, 'build_index', side_effect=OperationalError('no such table')):
+            suggestions.warm_on_startup()
+
+    def test_clear_during_build_is_not_lost(self):
+        build_index = suggestions.build_index
+
+        def build_and_change():
+            index = build_index()
+            suggestions.clear()
+            return index
+
+        with patch.object(suggestions, 'build_index', build_and_change):
+            suggestions.warm()
+        self.assertTrue(suggestions._is_stale(suggestions.INDEX_VERSION.current()))
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class CategoryViewTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Гостиная', slug='living-room')
+        self.subcategory = Category.objects.create(title='Диваны', slug='sofas', parent=self.category)
+        self.brand = Brand.objects.create(title='Икеа')
+        self.products = [
+            create_product(self.category if i % 2 else self.subcategory, i, brand=self.brand if i < 10 else None,
+                           color_name='Серый' if i % 3 else 'Белый')
+            for i in range(60)
+        ]
+
+    def get(self, slug='living-room', **params):
+        response = self.client.get(reverse('category_page', kwargs={'slug': slug}), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def walk(self, **params):
+        pages, response = [], self.get(**params)
+        while True:
+            pages.append(list(response.context['products']))
+            if 'next_page_query' not in response.context:
+                return pages
+            response = self.client.get(f'{reverse("category_page", kwargs={"slug": "living-room"})}?'
+                                       f'{response.context["next_page_query"]}')
+
+    def test_pages_cover_subcategories_in_order(self):
+        pages = self.walk()
+        self.assertEqual([len(page) for page in pages], [24, 24, 12])
+        self.assertEqual(sum(pages, []), self.products[::-1])
+
+    def test_deep_page_costs_the_same(self):
+        self.get()
+        with CaptureQueriesContext(connection) as first:
+            response = self.get()
+        cursor = response.context['next_page_query']
+        with CaptureQueriesContext(connection) as second:
+            self.client.get(f'{reverse("category_page", kwargs={"slug": "living-room"})}?{cursor}')
+        self.assertEqual(len(first), len(second))
+
+    def test_sort_and_filters(self):
+        pages = self.walk(sort='cheap', price_min=1005, price_max=1040, color='Серый')
+        products = sum(pages, [])
+        expected = [p for p in self.products if 1005 <= p.price <= 1040 and p.color_name == 'Серый']
+        self.assertEqual(products, expected)
+        products = sum(self.walk(brand=self.brand.pk, sort='expensive'), [])
+        self.assertEqual(products, self.products[:10][::-1])
+
+    def test_unknown_category_and_bad_cursor(self):
+        self.assertEqual(self.client.get(reverse('category_page', kwargs={'slug': 'missing'})).status_code, 404)
+        response = self.get(cursor='broken')
+        self.assertEqual(list(response.context['products']), self.products[::-1][:24])
+
+    def test_cursor_of_another_sort_starts_over(self):
+        cursor = QueryDict(self.get().context['next_page_query'])['cursor']
+        response = self.get(sort='cheap', cursor=cursor)
+        self.assertEqual(list(response.context['products']), self.products[:24])
+
+    def test_cursor_bounds_the_first_field(self):
+        response = self.get()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'{reverse("category_page", kwargs={"slug": "living-room"})}?'
+                            f'{response.context["next_page_query"]}')
+        page_query = next(query['sql'] for query in queries if 'LIMIT 25' in query['sql'])
+        self.assertIn('"created_at" <=', page_query)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class CategoryTreeTest(TestCase):
+    def setUp(self):
+        self.root = Category.objects.create(title='Гостиная', slug='living-room', image='categories/living.svg')
+        self.child = Category.objects.create(title='Диваны', slug='sofas', parent=self.root)
+        self.grandchild = Category.objects.create(title='Угловые', slug='corner-sofas', parent=self.child)
+
+    def test_tree_and_breadcrumbs(self):
+        roots = category_tree.get_root_categories()
+        self.assertEqual([node.title for node in roots], ['Гостиная'])
+        self.assertEqual(roots[0].get_image_category(), '/media/categories/living.svg')
+        self.assertEqual(roots[0].subcategories[0].get_absolute_url(), self.child.get_absolute_url())
+        self.assertEqual([node.pk for node in category_tree.get_breadcrumbs(self.grandchild.pk)],
+                         [self.root.pk, self.child.pk, self.grandchild.pk])
+        self.assertEqual(category_tree.get_descendant_ids(self.root.pk),
+                         [self.root.pk, self.child.pk, self.grandchild.pk])
+
+    def test_navigation_costs_no_queries(self):
+        category_tree.get_tree()
+        template = Template('{% load digital_tags %}{% get_categories as categories %}'
+                            '{% for category in categories %}{{ category.get_absolute_url }}{% endfor %}')
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context()), self.root.get_absolute_url())
+
+    def test_tree_follows_changes(self):
+        category_tree.get_tree()
+        self.child.parent = None
+        self.child.save()
+        self.assertEqual([node.title for node in category_tree.get_root_categories()], ['Гостиная', 'Диваны'])
+        self.root.delete()
+        self.assertIsNone(category_tree.get_category_id('living-room'))
+
+    def test_tree_follows_other_workers(self):
+        category_tree.get_tree()
+        # another worker saved the category, only the shared version tells this one
+        Category.objects.filter(pk=self.child.pk).update(slug='couches')
+        self.assertEqual(category_tree.get_category_id('sofas'), self.child.pk)
+        caches['default'].set(category_tree.TREE_VERSION.key, 'other')
+        self.assertEqual(category_tree.get_category_id('couches'), self.child.pk)
+
+        Category.objects.filter(pk=self.child.pk).update(slug='sofas')
+        category_tree._tree['built_at'] -= category_tree.TREE_VERSION.timeout + 1
+        self.assertEqual(category_tree.get_category_id('sofas'), self.child.pk)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class ProductCardCacheTest(TestCase):
+    def setUp(self):
+        caches['fragments'].clear()
+        fragments.stats.clear()
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(5)]
+        FavoriteProduct.objects.create(user=self.user, product=self.products[0])
+
+    def get_page(self):
+        return self.client.get(reverse('category_page', kwargs={'slug': self.category.slug}))
+
+    def test_cards_are_cached_but_hearts_are_per_user(self):
+        self.get_page()
+        self.assertEqual(fragments.stats['misses'], 5)
+        self.client.force_login(self.user)
+        response = self.get_page()
+        self.assertEqual(fragments.stats['hits'], 5)
+        self.assertContains(response, '❤️', count=1)
+        self.client.logout()
+        self.assertNotContains(self.get_page(), '❤️')
+
+    def test_cached_card_costs_no_queries(self):
+        product = Product.objects.get(pk=self.products[1].pk)
+        fragments.render_product_card(product, False)
+        product = Product.objects.get(pk=self.products[1].pk)
+        with self.assertNumQueries(0):
+            self.assertIn('/media/products/1.png', fragments.render_product_card(product, False))
+
+    def test_edited_product_is_rendered_again(self):
+        self.get_page()
+        product = self.products[2]
+        product.title = 'Новое название'
+        product.save()
+        self.assertContains(self.get_page(), 'Новое название')
+        self.assertEqual(fragments.stats['misses'], 6)
+
+
+class CartForAuthenticatedUserTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.product = create_product(self.category, 0)
+        self.product.quantity = 2
+        self.product.save()
+        self.cart = make_cart(self.user)
+
+    def line_quantity(self):
+        return OrderProduct.objects.get(order=self.cart.get_order(), product=self.product).quantity
+
+    def test_add_reserves_stock(self):
+        self.assertTrue(self.cart.add_or_delete(self.product.pk, 'add'))
+        self.assertTrue(self.cart.add_or_delete(self.product.pk, 'add'))
+        self.assertFalse(self.cart.add_or_delete(self.product.pk, 'add'))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 0)
+        self.assertEqual(self.line_quantity(), 2)
+
+    def test_delete_returns_stock(self):
+        self.cart.add_or_delete(self.product.pk, 'add')
+        self.assertTrue(self.cart.add_or_delete(self.product.pk, 'del'))
+        self.assertFalse(self.cart.add_or_delete(self.product.pk, 'del'))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 2)
+        self.assertFalse(OrderProduct.objects.exists())
+
+    def test_one_open_order_per_customer(self):
+        order = self.cart.get_order()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(customer=order.customer)
+        Order.objects.filter(pk=order.pk).update(is_completed=True)
+        self.assertNotEqual(self.cart.get_order().pk, order.pk)
+
+
+class CartConcurrencyTest(TransactionTestCase):
+    def test_concurrent_adds_do_not_oversell(self):
+        category = Category.objects.create(title='Категория', slug='category')
+        product = create_product(category, 0)
+        Product.objects.filter(pk=product.pk).update(quantity=5)
+        users = [User.objects.create(username=f'buyer{i}') for i in range(8)]
+        results = []
+
+        def buy(user):
+            cart = make_cart(user)
+            try:
+                for _ in range(3):
+                    while True:
+                        try:
+                            results.append(cart.add_or_delete(product.pk, 'add'))
+                            break
+                        except OperationalError:
+                            # the shared in-memory test database reports lock contention instead of waiting
+                            time.sleep(0.001)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        reserved = OrderProduct.objects.aggregate(total=Sum('quantity'))['total']
+        self.assertEqual(product.quantity, 0)
+        self.assertEqual(reserved, 5)
+        self.assertEqual(results.count(True), 5)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class CartTotalsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.cart = make_cart(self.user)
+        self.client.force_login(self.user)
+        category_tree.get_tree()
+
+    def fill_cart(self, count):
+        for i in range(count):
+            product = create_product(self.category, Product.objects.count())
+            self.cart.add_or_delete(product.pk, 'add')
+            self.cart.add_or_delete(product.pk, 'add')
+
+    def count_cart_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('my_cart'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_totals(self):
+        self.fill_cart(3)
+        cart_info = self.cart.get_cart_info()
+        self.assertEqual(cart_info['cart_total_quantity'], 6)
+        self.assertEqual(cart_info['cart_total_price'], 2 * (1000 + 1001 + 1002))
+
+    def test_empty_cart_totals(self):
+        order = self.cart.get_order()
+        self.assertEqual(order.get_cart_total_quantity, 0)
+        self.assertEqual(order.get_cart_total_price, 0)
+
+    def test_cart_page_query_count_does_not_grow(self):
+        self.fill_cart(1)
+        self.count_cart_queries()
+        small = self.count_cart_queries()
+        self.fill_cart(10)
+        self.assertEqual(small, self.count_cart_queries())
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class CartSummaryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(2)]
+        self.client.force_login(self.user)
+        category_tree.get_tree()
+
+    def test_summary_follows_cart_changes(self):
+        for product in (self.products[0], self.products[0], self.products[1]):
+            self.client.get(reverse('to_cart', kwargs={'pk': product.pk, 'action': 'add'}))
+        self.assertEqual(self.client.session['cart_summary']['quantity'], 3)
+        self.assertEqual(self.client.session['cart_summary']['total_price'], 1000 * 2 + 1001)
+        self.client.get(reverse('to_cart', kwargs={'pk': self.products[0].pk, 'action': 'del'}))
+        self.assertEqual(self.client.session['cart_summary']['quantity'], 2)
+        self.client.get(reverse('clear_cart'))
+        self.assertEqual(self.client.session['cart_summary']['quantity'], 0)
+
+    def test_badge_costs_no_cart_queries(self):
+        self.client.get(reverse('to_cart', kwargs={'pk': self.products[0].pk, 'action': 'add'}))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('about_us'))
+        self.assertContains(response, 'badge rounded-pill bg-danger">1</span>')
+        self.assertFalse([q for q in queries if 'digital_order' in q['sql']])
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class SessionCartTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(2)]
+        Product.objects.filter(pk=self.products[1].pk).update(quantity=1)
+
+    def add(self, product, action='add'):
+        self.client.get(reverse('to_cart', kwargs={'pk': product.pk, 'action': action}))
+
+    def test_anonymous_cart_writes_no_orders(self):
+        self.add(self.products[0])
+        self.add(self.products[0])
+        self.add(self.products[1])
+        self.add(self.products[1])
+        self.assertFalse(Customer.objects.exists())
+        self.assertFalse(OrderProduct.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity, 10)
+        response = self.client.get(reverse('my_cart'))
+        self.assertEqual(response.context['order'].get_cart_total_quantity, 3)
+        self.assertEqual(self.client.session['cart_summary']['quantity'], 3)
+
+    def test_cart_is_merged_on_login(self):
+        make_cart(self.user).add_or_delete(self.products[0].pk, 'add')
+        self.add(self.products[0])
+        self.add(self.products[1])
+        Product.objects.filter(pk=self.products[1].pk).update(quantity=0)
+        self.client.post(reverse('login'), {'username': 'buyer', 'password': 'password'})
+
+        lines = dict(OrderProduct.objects.values_list('product_id', 'quantity'))
+        self.assertEqual(lines, {self.products[0].pk: 2})
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity, 8)
+        self.assertNotIn('cart', self.client.session)
+        response = self.client.get(reverse('my_cart'))
+        self.assertEqual(response.context['order'].get_cart_total_quantity, 2)
+
+
+class CartApiTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(3)]
+
+    def post(self, operations, mode='set'):
+        return self.client.post(reverse('cart_api'), {'mode': mode, 'operations': operations},
+                                content_type='application/json')
+
+    def test_set_and_add_for_user(self):
+        self.client.force_login(self.user)
+        response = self.post([{'product_id': self.products[0].pk, 'quantity': 5},
+                              {'product_id': self.products[1].pk, 'quantity': 20}])
+        self.assertEqual(response.json()['cart'], {str(self.products[0].pk): 5, str(self.products[1].pk): 10})
+        self.assertEqual(response.json()['summary']['quantity'], 15)
+
+        response = self.post([{'product_id': self.products[0].pk, 'quantity': 2},
+                              {'product_id': self.products[1].pk, 'quantity': 0}])
+        self.assertEqual(response.json()['cart'], {str(self.products[0].pk): 2})
+        self.assertEqual(Product.objects.get(pk=self.products[1].pk).quantity, 10)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity, 8)
+
+        response = self.post([{'product_id': self.products[0].pk, 'quantity': 3}], mode='add')
+        self.assertEqual(response.json()['cart'], {str(self.products[0].pk): 5})
+
+    def test_one_reservation_query_per_product(self):
+        self.client.force_login(self.user)
+        operations = [{'product_id': product.pk, 'quantity': 2} for product in self.products]
+        with CaptureQueriesContext(connection) as queries:
+            self.post(operations)
+        updates = [q for q in queries if q['sql'].startswith('UPDATE "digital_product"')]
+        self.assertEqual(len(updates), len(self.products))
+
+    def test_anonymous_cart(self):
+        response = self.post([{'product_id': self.products[2].pk, 'quantity': 4}])
+        self.assertEqual(response.json()['cart'], {str(self.products[2].pk): 4})
+        self.assertFalse(OrderProduct.objects.exists())
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post([{'product_id': 'x'}]).status_code, 400)
+        self.assertEqual(self.post([], mode='replace').status_code, 400)
+        negative = [{'product_id': self.products[0].pk, 'quantity': -1}]
+        self.assertEqual(self.post(negative, mode='add').status_code, 400)
+        self.client.force_login(self.user)
+        self.assertEqual(self.post(negative, mode='add').status_code, 400)
+        self.assertEqual(self.client.get(reverse('cart_api')).status_code, 405)
+
+
+class ClearCartTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.cart = make_cart(self.user)
+        self.client.force_login(self.user)
+
+    def fill_cart(self, count):
+        products = Product.objects.bulk_create([
+            Product(title=f'Товар {i}', price=100, quantity=7, slug=f'bulk-{count}-{i}', category=self.category)
+            for i in range(count)
+        ])
+        order = self.cart.get_order()
+        OrderProduct.objects.bulk_create([OrderProduct(order=order, product=product, quantity=3)
+                                          for product in products])
+        return products
+
+    def count_release_queries(self, count):
+        products = self.fill_cart(count)
+        with CaptureQueriesContext(connection) as queries:
+            self.cart.release()
+        self.assertFalse(OrderProduct.objects.exists())
+        self.assertEqual(set(Product.objects.filter(pk__in=[p.pk for p in products])
+                             .values_list('quantity', flat=True)), {10})
+        return len(queries)
+
+    def test_release_query_count_is_constant(self):
+        self.assertEqual(self.count_release_queries(1), self.count_release_queries(500))
+
+    def test_clear_cart_view_restocks(self):
+        products = self.fill_cart(2)
+        self.client.get(reverse('clear_cart'))
+        self.assertEqual(Product.objects.get(pk=products[1].pk).quantity, 10)
+        self.assertEqual(self.client.session['cart_summary']['quantity'], 0)
+
+
+class ReservationExpiryTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(2)]
+        self.carts = [make_cart(User.objects.create(username=f'buyer{i}')) for i in range(3)]
+        for cart in self.carts:
+            cart.add_products({self.products[0].pk: 2, self.products[1].pk: 1})
+
+    def expire(self, cart):
+        OrderProduct.objects.filter(order=cart.get_order()).update(added_at=timezone.now() - timedelta(hours=2))
+
+    def test_expired_lines_return_to_stock(self):
+        self.expire(self.carts[0])
+        self.expire(self.carts[1])
+        self.assertEqual(get_stock_metrics()['expired'], 6)
+        self.assertEqual(release_expired_reservations(60, batch_size=1), 4)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity, 8)
+        self.assertEqual(Product.objects.get(pk=self.products[1].pk).quantity, 9)
+        self.assertEqual(OrderProduct.objects.count(), 2)
+        self.assertEqual(get_stock_metrics()['reserved'], 3)
+
+    def test_renewed_line_is_kept(self):
+        self.expire(self.carts[0])
+        self.carts[0].add_or_delete(self.products[0].pk, 'add')
+        call_command('release_expired_reservations', stdout=StringIO())
+        self.assertEqual(OrderProduct.objects.filter(order=self.carts[0].get_order()).count(), 1)
+
+    def test_checkout_keeps_stock_while_session_can_be_paid(self):
+        order = self.carts[0].get_order()
+        self.expire(self.carts[0])
+        payments.start_checkout(order)
+        self.assertEqual(release_expired_reservations(0), 4)
+        self.assertEqual(OrderProduct.objects.filter(order=order).count(), 2)
+
+        hold = timedelta(minutes=payments.checkout_hold_minutes() + 1)
+        OrderProduct.objects.filter(order=order).update(added_at=timezone.now() - hold)
+        self.assertEqual(release_expired_reservations(0), 2)
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    # answers like the Stripe API for the few endpoints the shop calls
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.calls.append({'path': self.path, 'headers': dict(self.headers), 'body': body})
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(500)
+            self.send_header('Stripe-Should-Retry', 'true')
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': {'type': 'api_error', 'message': 'boom'}}).encode())
+            return
+
+        if self.path.endswith('/expire'):
+            session = self.find_session()
+            if session['status'] != 'open':
+                return self.respond(400, {'error': {'type': 'invalid_request_error', 'message': 'not open'}})
+            session['status'] = 'expired'
+            return self.respond(200, session)
+
+        key = self.headers.get('Idempotency-Key')
+        session = self.server.sessions.setdefault(key, {
+            'id': f'cs_test_{len(self.server.sessions)}',
+            'object': 'checkout.session',
+            'status': 'open',
+            'url': f'https://checkout.stripe.test/{len(self.server.sessions)}',
+        })
+        self.respond(200, session)
+
+    def do_GET(self):
+        self.respond(200, self.find_session())
+
+    def find_session(self):
+        session_id = self.path.split('/')[4]
+        return next(session for session in self.server.sessions.values() if session['id'] == session_id)
+
+    def respond(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeStripeHandler)
+        self.calls, self.sessions, self.failures = [], {}, 0
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class CheckoutSessionTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.city = City.objects.create(city_name='Ташкент')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.product = create_product(self.category, 0)
+        self.cart = make_cart(self.user)
+        self.cart.add_products({self.product.pk: 2})
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__)
+        settings_override = override_settings(STRIPE_API_BASE=self.stripe.url, STRIPE_TIMEOUT=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        payments.reset_stripe()
+        self.addCleanup(payments.reset_stripe)
+        self.addCleanup(setattr, stripe, 'api_base', stripe.api_base)
+
+    def pay(self):
+        async def post():
+            client = AsyncClient()
+            await sync_to_async(client.force_login)(self.user)
+            return await client.post(reverse('payment'), {
+                'first_name': 'Иван', 'last_name': 'Иванов', 'email': 'buyer@example.com',
+                'address': 'ул. Навои 1', 'city': self.city.pk, 'region': 'Ташкент', 'phone': '998000000'
+            })
+        return async_to_sync(post)()
+
+    def test_redirects_to_stripe_with_idempotent_session(self):
+        first = self.pay()
+        second = self.pay()
+        self.assertEqual(first.status_code, 303)
+        self.assertEqual(first['Location'], second['Location'])
+        call = self.stripe.calls[0]
+        self.assertEqual(call['body']['line_items[0][price_data][unit_amount]'], ['2000'])
+        expires_in = int(call['body']['expires_at'][0]) - time.time()
+        self.assertTrue(60 * 60 <= expires_in <= 70 * 60)
+        self.assertTrue(call['headers']['Idempotency-Key'].startswith(f'checkout-{self.cart.get_order().pk}-'))
+        self.assertEqual(ShippingAdress.objects.count(), 1)
+
+        self.cart.add_or_delete(self.product.pk, 'add')
+        self.assertNotEqual(self.pay()['Location'], first['Location'])
+
+    def test_cart_change_expires_the_open_session(self):
+        self.pay()
+        order = Order.objects.get(pk=self.cart.get_order().pk)
+        self.assertEqual((order.total_price, order.checkout_session_id), (2000, 'cs_test_0'))
+        self.assertTrue(self.cart.add_or_delete(self.product.pk, 'add'))
+        self.assertEqual(self.stripe.calls[-1]['path'], '/v1/checkout/sessions/cs_test_0/expire')
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual((order.total_price, order.checkout_session_id), (None, ''))
+
+    def test_paid_order_is_frozen(self):
+        self.pay()
+        next(iter(self.stripe.sessions.values()))['status'] = 'complete'
+        with self.assertRaises(CheckoutInProgress):
+            self.cart.add_or_delete(self.product.pk, 'add')
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('cart_api'), json.dumps({'operations': [
+            {'product_id': self.product.pk, 'quantity': 5}]}), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(OrderProduct.objects.get(order=self.cart.get_order()).quantity, 2)
+        self.assertEqual(Order.objects.get(pk=self.cart.get_order().pk).total_price, 2000)
+
+    def test_retries_server_errors(self):
+        self.stripe.failures = 1
+        self.assertEqual(self.pay().status_code, 303)
+        self.assertEqual(len(self.stripe.calls), 2)
+        self.assertEqual(len({call['headers']['Idempotency-Key'] for call in self.stripe.calls}), 1)
+
+    def test_unavailable_stripe_returns_to_checkout(self):
+        self.stripe.failures = 10
+        response = self.pay()
+        self.assertEqual(response['Location'], reverse('checkout'))
+
+
+# trimmed copy of a checkout.session.completed event delivered by Stripe in test mode
+CHECKOUT_COMPLETED_EVENT = {
+    'id': 'evt_1OlnKxAxRYRPHE83wHk1xL1c',
+    'object': 'event',
+    'api_version': '2023-10-16',
+    'created': 1708253421,
+    'type': 'checkout.session.completed',
+    'livemode': False,
+    'pending_webhooks': 1,
+    'data': {
+        'object': {
+            'id': 'cs_test_a1Xf2q3bWz',
+            'object': 'checkout.session',
+            'amount_total': 2000,
+            'currency': 'usd',
+            'client_reference_id': None,
+            'metadata': {'order_id': None},
+            'mode': 'payment',
+            'payment_status': 'paid',
+            'status': 'complete',
+        }
+    },
+}
+
+WEBHOOK_SECRET = 'whsec_test_secret'
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class StripeWebhookTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.product = create_product(self.category, 0)
+        self.cart = make_cart(self.user)
+        self.cart.add_products({self.product.pk: 2})
+        self.order = self.cart.get_order()
+        payments.snapshot_orders([self.order.pk])
+
+    def event(self, event_id=None, order_id=None, payment_status='paid', amount_total=2000, currency='usd'):
+        event = json.loads(json.dumps(CHECKOUT_COMPLETED_EVENT))
+        event['id'] = event_id or event['id']
+        event['data']['object']['metadata']['order_id'] = str(order_id or self.order.pk)
+        event['data']['object']['payment_status'] = payment_status
+        event['data']['object']['amount_total'] = amount_total
+        event['data']['object']['currency'] = currency
+        return json.dumps(event)
+
+    def deliver(self, payload, secret=WEBHOOK_SECRET):
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(reverse('stripe_webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    def test_paid_order_is_finalized_by_worker(self):
+        self.assertEqual(self.deliver(self.event()).status_code, 200)
+        self.assertEqual(self.deliver(self.event()).status_code, 200)
+        self.assertFalse(Order.objects.get(pk=self.order.pk).is_completed)
+
+        call_command('process_payment_events', stdout=StringIO())
+        Product.objects.filter(pk=self.product.pk).update(price=5000)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertTrue(order.is_completed)
+        self.assertEqual(order.get_cart_total_price, 2000)
+        self.assertEqual(PaymentEvent.objects.filter(processed_at__isnull=False).count(), 1)
+        self.assertNotEqual(self.cart.get_order().pk, order.pk)
+
+    def test_stock_stays_taken_and_unpaid_sessions_are_ignored(self):
+        self.deliver(self.event(event_id='evt_unpaid', payment_status='unpaid'))
+        process_payment_events()
+        self.assertFalse(Order.objects.get(pk=self.order.pk).is_completed)
+        self.deliver(self.event())
+        process_payment_events()
+        self.assertEqual(Product.objects.get(pk=self.product.pk).quantity, 8)
+        self.assertEqual(release_expired_reservations(minutes=0), 0)
+
+    def test_bad_signature_is_rejected(self):
+        self.assertEqual(self.deliver(self.event(), secret='whsec_other').status_code, 400)
+        self.assertEqual(self.client.post(reverse('stripe_webhook'), 'x', content_type='application/json').status_code,
+                         400)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+    def test_unset_secret_rejects_everything(self):
+        with override_settings(STRIPE_WEBHOOK_SECRET=''):
+            self.assertEqual(self.deliver(self.event(), secret='').status_code, 400)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+    def test_underpaid_order_stays_open(self):
+        self.deliver(self.event(event_id='evt_cheap', amount_total=1000))
+        self.deliver(self.event(event_id='evt_eur', currency='eur'))
+        with self.assertLogs('digital.payments', 'WARNING') as logs:
+            process_payment_events()
+        self.assertEqual(len(logs.output), 2)
+        self.assertFalse(Order.objects.get(pk=self.order.pk).is_completed)
+
+
+class OrderSnapshotTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.products = [create_product(self.category, i) for i in range(2)]
+        self.cart = make_cart(User.objects.create(username='buyer'))
+        self.cart.add_products({self.products[0].pk: 2, self.products[1].pk: 1})
+        self.order = self.cart.get_order()
+
+    def test_snapshot_survives_catalog_changes(self):
+        payments.snapshot_orders([self.order.pk])
+        Product.objects.filter(pk=self.products[0].pk).update(title='Другое', price=1)
+        Gallery.objects.filter(product=self.products[0]).delete()
+
+        line = OrderProduct.objects.get(order=self.order, product=self.products[0])
+        self.assertEqual((line.title, line.price, line.image_url), ('Товар 0', 1000, '/media/products/0.png'))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total_price, 2 * 1000 + 1001)
+
+    def test_finalize_keeps_checkout_prices(self):
+        payments.snapshot_orders([self.order.pk])
+        Product.objects.filter(pk=self.products[0].pk).update(price=1)
+        payments.finalize_orders([(self.order.pk, 3001, 'usd')])
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertTrue(order.is_completed)
+        self.assertEqual(order.total_price, 2 * 1000 + 1001)
+        self.assertEqual(OrderProduct.objects.get(order=order, product=self.products[0]).price, 1000)
+
+    def test_cart_changed_after_checkout_is_not_completed(self):
+        payments.snapshot_orders([self.order.pk])
+        self.cart.add_or_delete(self.products[0].pk, 'add')
+        self.assertFalse(OrderProduct.objects.filter(order=self.order, price__isnull=False).exists())
+
+        with self.assertLogs('digital.payments', 'WARNING'):
+            payments.finalize_orders([(self.order.pk, 3001, 'usd')])
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertFalse(order.is_completed)
+        self.assertIsNone(order.total_price)
+        self.assertEqual(order.get_cart_total_price, 3 * 1000 + 1001)
+
+    def test_released_cart_is_not_completed(self):
+        payments.start_checkout(self.order)
+        self.cart.release()
+        with self.assertLogs('digital.payments', 'WARNING'):
+            payments.finalize_orders([(self.order.pk, 3001, 'usd')])
+        self.assertFalse(Order.objects.get(pk=self.order.pk).is_completed)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity, 10)
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class OrderHistoryTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(title='Категория', slug='category')
+        product = create_product(category, 0)
+        self.user = User.objects.create(username='buyer')
+        Profile.objects.create(user=self.user)
+        customer = Customer.objects.create(user=self.user)
+        self.orders = []
+        for i in range(25):
+            order = Order.objects.create(customer=customer, is_completed=True)
+            OrderProduct.objects.create(order=order, product=product, quantity=i + 1)
+            self.orders.append(order)
+        payments.snapshot_orders([order.pk for order in self.orders])
+        self.client.force_login(self.user)
+        self.url = reverse('profile', kwargs={'pk': self.user.pk})
+
+    def walk(self):
+        pages, response = [], self.client.get(self.url)
+        while True:
+            pages.append(list(response.context['orders']))
+            if not response.context['orders'].has_next:
+                return pages
+            response = self.client.get(self.url, {'cursor': response.context['orders'].next_cursor})
+
+    def test_pages_cover_orders_newest_first(self):
+        pages = self.walk()
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        expected = sorted(self.orders, key=lambda order: (order.created_at, order.pk), reverse=True)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(pages[0][0].total_price, 25 * 1000)
+
+    def test_deep_page_costs_the_same(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as first:
+            response = self.client.get(self.url)
+        with CaptureQueriesContext(connection) as second:
+            self.client.get(self.url, {'cursor': response.context['orders'].next_cursor})
+        self.assertEqual(len(first), len(second))
+
+    def test_history_does_not_read_the_catalog(self):
+        Product.objects.update(title='Другое')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        history_lines = [query['sql'] for query in queries if '"digital_orderproduct"."order_id" IN' in query['sql']]
+        self.assertEqual(len(history_lines), 1)
+        self.assertNotIn('digital_product', history_lines[0])
+        self.assertContains(response, 'Товар 0')
+        self.assertNotContains(response, 'Другое')
+
+    def test_other_profiles_hide_orders(self):
+        other = User.objects.create(username='other')
+        Profile.objects.create(user=other)
+        response = self.client.get(reverse('profile', kwargs={'pk': other.pk}))
+        self.assertNotIn('orders', response.context)
+
+
+def use_temp_media(test):
+    media_root = tempfile.TemporaryDirectory()
+    test.addCleanup(media_root.cleanup)
+    media_override = override_settings(MEDIA_ROOT=media_root.name)
+    media_override.enable()
+    test.addCleanup(media_override.disable)
+
+
+def make_png(width, height):
+    buffer = BytesIO()
+    PILImage.new('RGB', (width, height), 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class ImageVariantsTest(TestCase):
+    def setUp(self):
+        use_temp_media(self)
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.product = Product.objects.create(title='Стул', price=1000, quantity=1, slug='chair',
+                                              category=self.category)
+
+    def test_upload_makes_webp_variants(self):
+        gallery = Gallery.objects.create(product=self.product,
+                                         image=SimpleUploadedFile('chair.png', make_png(1600, 800)))
+        stem = gallery.image.name[len('products/'):-len('.png')]
+        self.assertEqual(gallery.variants['widths'], [320, 640, 1280, 1600])
+        for width in gallery.variants['widths']:
+            self.assertTrue(default_storage.exists(f'products/variants/{stem}-{width}w.webp'))
+
+        product = Product.objects.select_related('primary_image').get(pk=self.product.pk)
+        self.assertEqual(product.get_image_product(), f'/media/products/variants/{stem}-640w.webp')
+        self.assertIn(f'/media/products/variants/{stem}-1600w.webp 1600w', product.get_image_srcset())
+        self.assertContains(self.client.get(reverse('product_detail', kwargs={'slug': 'chair'})),
+                            f'{stem}-320w.webp 320w')
+
+        gallery.delete()
+        self.assertFalse(default_storage.exists(f'products/variants/{stem}-320w.webp'))
+
+    def test_small_images_are_not_upscaled(self):
+        gallery = Gallery.objects.create(product=self.product,
+                                         image=SimpleUploadedFile('chair.png', make_png(200, 100)))
+        self.assertEqual(gallery.variants['widths'], [200])
+        self.assertTrue(gallery.get_image_url().endswith('-200w.webp'))
+
+    def test_identical_uploads_share_one_file(self):
+        first = Gallery.objects.create(product=self.product, image=SimpleUploadedFile('a.png', make_png(400, 400)))
+        second = Gallery.objects.create(product=self.product, image=SimpleUploadedFile('b.PNG', make_png(400, 400)))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(media.is_hashed(first.image.name))
+        self.assertEqual(sorted(os.listdir(os.path.join(settings.MEDIA_ROOT, 'products'))),
+                         [os.path.basename(first.image.name), 'variants'])
+        first.delete()
+        self.assertTrue(default_storage.exists(variant_name(second.image.name, 400)))
+
+    def test_command_backfills_existing_images(self):
+        default_storage.save('products/old.png', ContentFile(make_png(800, 800)))
+        old = Gallery.objects.create(product=self.product, image='products/old.png')
+        Gallery.objects.create(product=self.product, image='products/missing.png')
+        self.assertEqual(old.variants, {})
+        self.assertEqual(old.get_image_url(), '/media/products/old.png')
+
+        out = StringIO()
+        call_command('generate_image_variants', workers=2, stdout=out)
+        self.assertIn('Обработано картинок: 1', out.getvalue())
+        self.assertIn('Не удалось обработать: 1', out.getvalue())
+        old.refresh_from_db()
+        self.assertEqual(old.variants, {'source': 'products/old.png', 'widths': [320, 640, 800]})
+        self.assertEqual(images.backfill_variants(workers=2), (0, 1))
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class PrimaryImageTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Категория', slug='category')
+
+    def test_follows_first_gallery_row(self):
+        product = create_product(self.category, 0)
+        second = Gallery.objects.create(product=product, image='products/1.png')
+        product.refresh_from_db()
+        self.assertEqual(product.get_image_product(), '/media/products/0.png')
+
+        Gallery.objects.filter(pk=product.primary_image_id).get().delete()
+        product.refresh_from_db()
+        self.assertEqual(product.primary_image_id, second.pk)
+        second.delete()
+        product.refresh_from_db()
+        self.assertIsNone(product.primary_image_id)
+        self.assertEqual(product.get_image_product(), '-')
+
+    def test_command_repairs_primary_images(self):
+        product = create_product(self.category, 0)
+        Product.objects.update(primary_image=None)
+        call_command('refresh_primary_images', stdout=StringIO())
+        self.assertEqual(Product.objects.get(pk=product.pk).get_image_product(), '/media/products/0.png')
+
+    def test_admin_changelist_costs_no_query_per_row(self):
+        admin = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(admin)
+        url = reverse('admin:digital_product_changelist')
+        create_product(self.category, 0)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        for i in range(1, 10):
+            create_product(self.category, i)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+        self.assertContains(response, '/media/products/9.png')
+        self.assertEqual(len(few), len(many))
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class MediaServingTest(TestCase):
+    def setUp(self):
+        use_temp_media(self)
+        self.category = Category.objects.create(title='Категория', slug='category')
+        self.product = Product.objects.create(title='Стул', price=1000, quantity=1, slug='chair',
+                                              category=self.category)
+        self.gallery = Gallery.objects.create(product=self.product,
+                                              image=SimpleUploadedFile('chair.png', make_png(50, 50)))
+        self.url = self.gallery.image.url
+        self.content = default_storage.open(self.gallery.image.name).read()
+
+    def test_hashed_files_are_cached_forever(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Cache-Control'], media.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+        response = self.client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_plain_names_are_revalidated(self):
+        default_storage.save('products/old.png', ContentFile(b'old'))
+        response = self.client.get('/media/products/old.png')
+        self.assertEqual(response['Cache-Control'], media.MEDIA_CACHE_CONTROL)
+        self.assertEqual(self.client.get('/media/products/missing.png').status_code, 404)
+
+    def test_ranges(self):
+        response = self.client.get(self.url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=-5'})
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=10-', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url, headers={'Range': f'bytes={len(self.content)}-'})
+        self.assertEqual(response.status_code, 416)
+
+    def test_command_hashes_old_uploads(self):
+        default_storage.save('categories/office-icon.svg', ContentFile(b'<svg/>'))
+        default_storage.save('categories/office-icon_QjM1Pkn.svg', ContentFile(b'<svg/>'))
+        first = Category.objects.create(title='Офис', slug='office', image='categories/office-icon.svg')
+        second = Category.objects.create(title='Кабинет', slug='cabinet', image='categories/office-icon_QjM1Pkn.svg')
+
+        out = StringIO()
+        call_command('hash_media_files', stdout=out)
+        self.assertIn('Переименовано файлов: 2', out.getvalue())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(media.is_hashed(first.image.name))
+
+
+class StaticBuildTest(TestCase):
+    def test_page_assets_follow_templates_and_stylesheets(self):
+        pages = static_build.find_page_assets()
+        self.assertNotIn('base.html', pages)
+        self.assertNotIn('digital/components/_product_card.html', pages)
+        assets = pages['digital/index.html']
+        self.assertIn('digital/style/fonts.css', assets)
+        self.assertIn('digital/assets/images/banner-1.png', assets)
+        # a browser takes woff2 out of every @font-face
+        self.assertIn('digital/assets/fontawesome/webfonts/fa-light-300.woff2', assets)
+        self.assertNotIn('digital/assets/fontawesome/webfonts/fa-light-300.eot', assets)
+
+    def test_unused_project_files_are_pruned(self):
+        unused = static_build.find_unused_assets()
+        self.assertIn('digital/assets/images/main/products/0.png', unused)
+        self.assertNotIn('digital/assets/images/banner-1.png', unused)
+        # the stylesheet still points at them, the manifest storage must find every one
+        self.assertNotIn('digital/assets/fontawesome/webfonts/fa-light-300.eot', unused)
+        self.assertFalse([path for path in unused if not path.startswith('digital/')])
+
+    def test_icon_fonts_keep_used_glyphs(self):
+        codepoints = static_build.find_used_codepoints()
+        self.assertIn(0xf002, codepoints)
+        self.assertIn(0xf007, codepoints)
+        self.assertNotIn(0xf641, codepoints)
+
+    def test_budget_report(self):
+        report = static_build.budget_report({'page.html': ['digital/style/style.css', 'digital/missing.css']}, 1)
+        sizes = report['page.html']
+        self.assertTrue(sizes['over_budget'])
+        self.assertLess(sizes['transfer'], sizes['raw'])
+        self.assertIsNone(sizes['assets']['digital/missing.css'])
+        self.assertFalse(static_build.budget_report({'page.html': ['digital/style/fonts.css']}, 100)['page.html'][
+            'over_budget'])
+
+
+@override_settings(STORAGES=TEST_STORAGES, CACHES=TEST_CACHES)
+class ProductAdminTest(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Гостиная', slug='living-room')
+        self.products = [create_product(self.category, i) for i in range(5)]
+        self.client.force_login(User.objects.create_superuser(username='admin', password='password'))
+        self.url = reverse('admin:digital_product_changelist')
+
+    def test_whole_table_uses_estimated_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        with patch('digital.pagination.ESTIMATE_THRESHOLD', 0), CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['cl'].result_count, 5)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql'] and 'digital_product' in query['sql']])
+
+        # a filtered list is counted exactly
+        search.rebuild_index()
+        with patch('digital.pagination.ESTIMATE_THRESHOLD', 0):
+            response = self.client.get(self.url, {'q': 'товар'})
+        self.assertEqual(response.context['cl'].result_count, 5)
+
+    def test_search_uses_full_text_index(self):
+        Product.objects.filter(pk=self.products[2].pk).update(title='Диван угловой')
+        search.rebuild_index()
+        response = self.client.get(self.url, {'q': 'диваны'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.products[2]])
+
+    def test_bulk_action_updates_in_one_statement(self):
+        data = {'action': 'change_price_quantity', 'select_across': '1', 'index': '0',
+                ACTION_CHECKBOX_NAME: [self.products[0].pk]}
+        response = self.client.post(self.url, data)
+        self.assertContains(response, 'Выбрано товаров: 5')
+
+        data.update(apply='1', price_mode='percent', price_value='10', quantity_mode='add', quantity_value='-3')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, data)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE "digital_product"')]), 1)
+        product = Product.objects.get(pk=self.products[4].pk)
+        self.assertAlmostEqual(product.price, 1004 * 1.1)
+        self.assertEqual(product.quantity, 7)
+
+    def test_autocomplete_for_category(self):
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'digital', 'model_name': 'product', 'field_name': 'category', 'term': 'Гост'})
+        self.assertEqual([result['text'] for result in response.json()['results']], ['Гостиная'])
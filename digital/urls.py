@@ -17,11 +17,14 @@ urlpatterns = [
     path('chg_profile/', chg_profile, name='chg_profile'),
     path('to_cart/<int:pk>/<str:action>/', to_cart_view, name='to_cart'),
     path('my_cart/', my_cart_view, name='my_cart'),
+    path('cart/api/', cart_api, name='cart_api'),
     path('search/', SearchResults.as_view(), name='search'),
+    path('search/suggestions/', search_suggestions, name='search_suggestions'),
     path('address/', contacts, name='contacts'),
     path('checkout/', checkout, name='checkout'),
     path('payment/', create_checkout_session, name='payment'),
     path('success/', success_payment, name='success'),
+    path('stripe/webhook/', stripe_webhook, name='stripe_webhook'),
     path('clear_cart/', clear_cart, name='clear_cart'),
     path('about_us/', about_us, name='about_us')
 
@@ -1,18 +1,42 @@
-from .models import Product, OrderProduct, Order, Customer
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Prefetch, F, OuterRef, Subquery, Sum, Count, Q
+from django.utils import timezone
+from django.db.models.functions import Coalesce
+
+from .models import Product, OrderProduct, Order, Customer, Category, FavoriteProduct, Gallery
+from .pagination import KeysetPaginator
+from .payments import cancel_checkout, checkout_hold_minutes, clear_snapshots
+
+CART_SUMMARY_SESSION_KEY = 'cart_summary'
+SESSION_CART_KEY = 'cart'
+ORDER_HISTORY_PER_PAGE = 10
+
+
+class CheckoutInProgress(Exception):
+    pass
 
 
 class CartForAuthenticatedUser:
     def __init__(self, request, product_id=None, action=None):
+        self.request = request
         self.user = request.user
 
         if product_id and action:
             self.add_or_delete(product_id, action)
 
-    def get_cart_info(self):
+    def get_order(self):
         customer, created = Customer.objects.get_or_create(user=self.user)
+        order, created = Order.objects.get_or_create(customer=customer, is_completed=False)
+        order.customer = customer
+        return order
 
-        order, created = Order.objects.get_or_create(customer=customer)
-        order_products = order.orderproduct_set.all()
+    def get_cart_info(self):
+        order = self.get_order()
+        order_products = order.orderproduct_set.select_related('product__primary_image')
 
         cart_total_quantity = order.get_cart_total_quantity
         cart_total_price = order.get_cart_total_price
@@ -23,33 +47,306 @@ class CartForAuthenticatedUser:
             'products': order_products
         }
 
+    def get_open_order(self):
+        # the lines of an order in checkout are what Stripe charges, they change only once its session is expired
+        order = self.get_order()
+        if order.total_price is not None and not cancel_checkout(order):
+            raise CheckoutInProgress
+        return order
+
     def add_or_delete(self, product_id, action):
-        order = self.get_cart_info()['order']
-        product = Product.objects.get(pk=product_id)
-        order_product, created = OrderProduct.objects.get_or_create(order=order, product=product)
+        order = self.get_open_order()
+        with transaction.atomic():
+            if action == 'add':
+                # the stock check and the decrement are one UPDATE, two buyers can't take the last item
+                reserved = Product.objects.filter(pk=product_id, quantity__gt=0).update(quantity=F('quantity') - 1)
+                if not reserved:
+                    return False
+                self._change_line(order, product_id, 1)
+            else:
+                released = OrderProduct.objects.filter(order=order, product_id=product_id, quantity__gt=0).update(
+                    quantity=F('quantity') - 1)
+                if not released:
+                    return False
+                Product.objects.filter(pk=product_id).update(quantity=F('quantity') + 1)
+                OrderProduct.objects.filter(order=order, product_id=product_id, quantity__lte=0).delete()
+            self.update_summary(order)
+        return True
+
+    def add_products(self, quantities):
+        # quantities is {product_id: quantity}; every product gets as much as is left in stock
+        order = self.get_open_order()
+        added = {}
+        with transaction.atomic():
+            for product_id, quantity in quantities.items():
+                reserved = self._reserve(product_id, quantity)
+                if reserved:
+                    self._change_line(order, product_id, reserved)
+                added[product_id] = reserved
+            self.update_summary(order)
+        return added
+
+    def set_quantities(self, quantities):
+        # quantities is {product_id: quantity wanted in the cart}, only the difference touches the stock
+        order = self.get_open_order()
+        with transaction.atomic():
+            current = dict(order.orderproduct_set.select_for_update().filter(product_id__in=quantities)
+                           .values_list('product_id', 'quantity'))
+            for product_id, quantity in quantities.items():
+                delta = max(quantity, 0) - (current.get(product_id) or 0)
+                if delta > 0:
+                    delta = self._reserve(product_id, delta)
+                elif delta < 0:
+                    Product.objects.filter(pk=product_id).update(quantity=F('quantity') - delta)
+                if delta:
+                    self._change_line(order, product_id, delta)
+            OrderProduct.objects.filter(order=order, quantity__lte=0).delete()
+            self.update_summary(order)
+        return self.get_quantities(order)
+
+    def get_quantities(self, order=None):
+        order = order or self.get_order()
+        return dict(order.orderproduct_set.values_list('product_id', 'quantity'))
+
+    def _reserve(self, product_id, quantity):
+        products = Product.objects.filter(pk=product_id)
+        while quantity > 0:
+            if products.filter(quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+                return quantity
+            # not enough stock, take what is left unless someone else takes it first
+            quantity = min(quantity, products.values_list('quantity', flat=True).first() or 0)
+        return 0
+
+    def update_summary(self, order):
+        # the header badge reads this copy from the session instead of querying the cart on every page
+        totals = order.calculate_cart_totals()
+        self.request.session[CART_SUMMARY_SESSION_KEY] = {
+            'quantity': totals['total_quantity'],
+            'total_price': totals['total_price'],
+            'updated_at': time.time()
+        }
 
-        if action == 'add' and product.quantity > 0:
-            order_product.quantity += 1
-            product.quantity -= 1
+    def _change_line(self, order, product_id, quantity):
+        lines = OrderProduct.objects.filter(order=order, product_id=product_id)
+        # added_at doubles as the reservation time, any change to the line renews it
+        if lines.update(quantity=F('quantity') + quantity, added_at=timezone.now()):
+            return
+        try:
+            with transaction.atomic():
+                OrderProduct.objects.create(order=order, product_id=product_id, quantity=quantity)
+        except IntegrityError:
+            # another request created the line in between
+            lines.update(quantity=F('quantity') + quantity)
+
+    def release(self):
+        # the cart is abandoned, every line goes back to stock in one UPDATE and one DELETE
+        order = self.get_open_order()
+        with transaction.atomic():
+            restock_lines(OrderProduct.objects.filter(order=order))
+            self.update_summary(order)
+
+
+class SessionCartLine:
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+
+    @property
+    def get_total_price(self):
+        return self.product.price * self.quantity
+
+
+# the cart of an anonymous visitor lives only in the session, nothing is written to the catalog or orders
+# until they log in and merge_session_cart moves it into an Order
+class SessionCart:
+    def __init__(self, request):
+        self.request = request
+        self.items = request.session.get(SESSION_CART_KEY, {})
+        self.get_cart_total_quantity = 0
+        self.get_cart_total_price = 0
+
+    def get_cart_info(self):
+        products = Product.objects.filter(pk__in=self.items).select_related('primary_image').in_bulk()
+        lines = [SessionCartLine(products[int(pk)], quantity) for pk, quantity in self.items.items()
+                 if int(pk) in products]
+        self.get_cart_total_quantity = sum(line.quantity for line in lines)
+        self.get_cart_total_price = sum(line.get_total_price for line in lines)
+        return {
+            'cart_total_quantity': self.get_cart_total_quantity,
+            'cart_total_price': self.get_cart_total_price,
+            'order': self,
+            'products': lines
+        }
+
+    def add_or_delete(self, product_id, action):
+        key = str(product_id)
+        quantity = self.items.get(key, 0)
+        if action == 'add':
+            if not Product.objects.filter(pk=product_id, quantity__gt=quantity).exists():
+                return False
+            self.items[key] = quantity + 1
         else:
-            order_product.quantity -= 1
-            product.quantity += 1
+            if not quantity:
+                return False
+            if quantity > 1:
+                self.items[key] = quantity - 1
+            else:
+                del self.items[key]
+        self.save()
+        return True
+
+    def add_products(self, quantities):
+        return self.set_quantities({
+            product_id: self.items.get(str(product_id), 0) + quantity for product_id, quantity in quantities.items()
+        })
 
-        product.save()
-        order_product.save()
+    def set_quantities(self, quantities):
+        stock = dict(Product.objects.filter(pk__in=quantities).values_list('pk', 'quantity'))
+        for product_id, quantity in quantities.items():
+            quantity = min(quantity, stock.get(product_id, 0))
+            if quantity > 0:
+                self.items[str(product_id)] = quantity
+            else:
+                self.items.pop(str(product_id), None)
+        self.save()
+        return self.get_quantities()
 
-        if order_product.quantity <= 0:
-            order_product.delete()
+    def get_quantities(self):
+        return {int(pk): quantity for pk, quantity in self.items.items()}
 
     def clear(self):
-        order = self.get_cart_info()['order']
-        order_products = order.orderproduct_set.all()
-        for product in order_products:
-            product.delete()
-        order.save()
+        self.items = {}
+        self.save()
+
+    def release(self):
+        # nothing was reserved for a session cart
+        self.clear()
+
+    def save(self):
+        self.request.session[SESSION_CART_KEY] = self.items
+        self.update_summary()
+
+    def update_summary(self):
+        prices = dict(Product.objects.filter(pk__in=self.items).values_list('pk', 'price'))
+        self.request.session[CART_SUMMARY_SESSION_KEY] = {
+            'quantity': sum(self.items.values()),
+            'total_price': sum(prices.get(int(pk), 0) * quantity for pk, quantity in self.items.items()),
+            'updated_at': time.time()
+        }
+
+
+def restock_lines(lines):
+    # one UPDATE returns the quantities of all given lines to stock, one DELETE removes the lines
+    line_quantity = (lines.filter(product=OuterRef('pk')).order_by().values('product')
+                     .annotate(total=Sum('quantity')).values('total'))
+    Product.objects.filter(pk__in=lines.filter(product__isnull=False).values('product_id')).update(
+        quantity=F('quantity') + Coalesce(Subquery(line_quantity), 0))
+    return lines.delete()[0]
+
+
+def release_expired_reservations(minutes=None, batch_size=1000):
+    minutes = settings.CART_RESERVATION_MINUTES if minutes is None else minutes
+    cutoff = timezone.now() - timedelta(minutes=minutes)
+    # an order in checkout has its total set, it is kept until its Stripe session can't be paid any more
+    checkout_cutoff = timezone.now() - timedelta(minutes=checkout_hold_minutes())
+    expired = OrderProduct.objects.filter(order__is_completed=False, added_at__lt=cutoff).filter(
+        Q(order__total_price__isnull=True) | Q(added_at__lt=checkout_cutoff))
+    released = 0
+    while True:
+        batch = list(expired.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return released
+        with transaction.atomic():
+            # the cutoff is checked again, a line renewed in the meantime stays in its cart
+            lines = expired.filter(pk__in=batch)
+            clear_snapshots(Order.objects.filter(pk__in=lines.values('order_id')))
+            released += restock_lines(lines)
+
+
+def get_stock_metrics():
+    reserved = OrderProduct.objects.filter(order__is_completed=False).aggregate(
+        total=Coalesce(Sum('quantity'), 0), expired=Coalesce(Sum('quantity', filter=Q(
+            added_at__lt=timezone.now() - timedelta(minutes=settings.CART_RESERVATION_MINUTES))), 0))
+    available = Product.objects.aggregate(total=Coalesce(Sum('quantity'), 0),
+                                          sold_out=Count('pk', filter=Q(quantity__lte=0)))
+    return {
+        'available': available['total'],
+        'reserved': reserved['total'],
+        'expired': reserved['expired'],
+        'sold_out_products': available['sold_out'],
+    }
+
+
+def get_cart(request):
+    if request.user.is_authenticated:
+        return CartForAuthenticatedUser(request)
+    return SessionCart(request)
+
+
+def merge_session_cart(request):
+    items = request.session.pop(SESSION_CART_KEY, None)
+    # the anonymous badge no longer applies, the user's own cart is summarised again on the next page
+    request.session.pop(CART_SUMMARY_SESSION_KEY, None)
+    if items:
+        CartForAuthenticatedUser(request).add_products({int(pk): quantity for pk, quantity in items.items()})
 
 
 def get_cart_data(request):
-    cart = CartForAuthenticatedUser(request)
+    cart = get_cart(request)
     cart_info = cart.get_cart_info()
     return cart_info
+
+
+def get_favorite_ids(user):
+    if not user.is_authenticated:
+        return set()
+    return set(FavoriteProduct.objects.filter(user=user).values_list('product_id', flat=True))
+
+
+def get_request_favorite_ids(request):
+    # loaded once per request, every product card then checks membership in O(1)
+    if not hasattr(request, '_favorite_ids'):
+        request._favorite_ids = get_favorite_ids(request.user)
+    return request._favorite_ids
+
+
+def get_order_history(user, cursor=None, per_page=ORDER_HISTORY_PER_PAGE):
+    # every paid line carries its own title, price and picture (older orders got them in 0026_order_history),
+    # the history never joins the catalog
+    lines = OrderProduct.objects.order_by('pk')
+    orders = Order.objects.filter(customer__user=user, is_completed=True).prefetch_related(
+        Prefetch('orderproduct_set', queryset=lines))
+    return KeysetPaginator(orders, ('-created_at', '-pk'), per_page).page(cursor)
+
+
+def refresh_primary_images(product_ids=None):
+    first_image = Gallery.objects.filter(product=OuterRef('pk')).order_by('pk').values('pk')[:1]
+    products = Product.objects.all() if product_ids is None else Product.objects.filter(pk__in=product_ids)
+    # edited_at changes too, the cached card of the product shows the new picture
+    return products.update(primary_image=Subquery(first_image), edited_at=timezone.now())
+
+
+def get_home_products():
+    products_qs = Product.objects.select_related('primary_image')
+    categories = Category.objects.filter(parent=None).prefetch_related(
+        Prefetch('products', queryset=products_qs)
+    )
+
+    products = []
+    for category in categories:
+        # the last product of every category is left out of the grid, as before
+        products.extend(list(category.products.all())[:-1])
+    return products
+
+
+def get_cart_summary(request):
+    summary = request.session.get(CART_SUMMARY_SESSION_KEY)
+    # reservations may have expired since the summary was written
+    if summary and request.user.is_authenticated and time.time() - summary.get('updated_at', 0) > settings.CART_RESERVATION_MINUTES * 60:
+        del request.session[CART_SUMMARY_SESSION_KEY]
+    if CART_SUMMARY_SESSION_KEY not in request.session:
+        if not request.user.is_authenticated:
+            return {'quantity': 0, 'total_price': 0}
+        cart = CartForAuthenticatedUser(request)
+        cart.update_summary(cart.get_order())
+    return request.session[CART_SUMMARY_SESSION_KEY]
@@ -1,32 +1,46 @@
-from random import randint
+import json
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
 from django.contrib.auth import login, logout, update_session_auth_hash
+from django.core.exceptions import ImproperlyConfigured
+from django.http import JsonResponse, Http404, HttpResponse
 from django.shortcuts import render, redirect
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from .models import *
 from django.views.generic import ListView, DetailView, UpdateView
-from .forms import LoginForm, RegisterForm, EditAccountForm, EditProfileForm, CustomerForm, ShippingForm
+from .forms import LoginForm, RegisterForm, EditAccountForm, EditProfileForm, CustomerForm, ShippingForm, \
+    ProductFilterForm
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 import stripe
-from shop import settings
 
 # Create your views here.
-from .utils import CartForAuthenticatedUser, get_cart_data
+from . import payments
+from .category_tree import get_category_id, get_descendant_ids, get_breadcrumbs
+from .pagination import KeysetPaginator
+from .recommendations import get_recommended_products
+from .search import SearchResultsList
+from .suggestions import suggest
+from .utils import CART_SUMMARY_SESSION_KEY, CartForAuthenticatedUser, CheckoutInProgress, get_cart, \
+    get_cart_data, get_cart_summary, get_home_products, get_order_history, get_request_favorite_ids
+
+CHECKOUT_IN_PROGRESS_MESSAGE = 'Заказ уже оплачивается, корзину можно будет изменить после оплаты'
 
 
 class ProductList(ListView):
     model = Product
-    context_object_name = 'categories'
+    context_object_name = 'products'
     template_name = 'digital/index.html'
     extra_context = {
         'title': 'Главная страница'
     }
 
     def get_queryset(self):
-        categories = Category.objects.filter(parent=None)
-        return categories
+        return get_home_products()
 
 
 def user_login(request):
@@ -71,12 +85,51 @@ class CategoryView(ListView):
     extra_context = {
         'title': 'Категории'
     }
+    per_page = 24
+    orderings = {
+        'new': ('-created_at', '-pk'),
+        'old': ('created_at', 'pk'),
+        'cheap': ('price', 'pk'),
+        'expensive': ('-price', '-pk'),
+    }
 
     def get_queryset(self):
-        category = Category.objects.get(slug=self.kwargs['slug'])
-        products = Product.objects.filter(category=category)
+        self.category_id = get_category_id(self.kwargs['slug'])
+        if self.category_id is None:
+            raise Http404('Категория не найдена')
+        category_ids = get_descendant_ids(self.category_id)
+        products = Product.objects.filter(category_id__in=category_ids).select_related('primary_image')
+
+        self.filter_form = ProductFilterForm(self.request.GET)
+        self.filter_form.fields['brand'].queryset = Brand.objects.filter(
+            product__category_id__in=category_ids).distinct()
+        if self.filter_form.is_valid():
+            data = self.filter_form.cleaned_data
+            if data['price_min'] is not None:
+                products = products.filter(price__gte=data['price_min'])
+            if data['price_max'] is not None:
+                products = products.filter(price__lte=data['price_max'])
+            if data['brand']:
+                products = products.filter(brand=data['brand'])
+            if data['color']:
+                products = products.filter(color_name=data['color'])
+            self.ordering = self.orderings[data['sort'] or 'new']
+        else:
+            self.ordering = self.orderings['new']
         return products
 
+    def get_context_data(self, **kwargs):
+        page = KeysetPaginator(self.object_list, self.ordering, self.per_page).page(self.request.GET.get('cursor'))
+        context = super().get_context_data(object_list=page.object_list, **kwargs)
+        context['filter_form'] = self.filter_form
+        context['breadcrumbs'] = get_breadcrumbs(self.category_id)
+        context['title'] = context['breadcrumbs'][-1].title
+        if page.has_next:
+            params = self.request.GET.copy()
+            params['cursor'] = page.next_cursor
+            context['next_page_query'] = params.urlencode()
+        return context
+
 
 def register_view(request):
     if request.user.is_authenticated:
@@ -107,25 +160,15 @@ def register_view(request):
 
 
 class ProductDetail(DetailView):
-    model = Product
+    queryset = Product.objects.select_related('primary_image')
     context_object_name = 'product'
 
     def get_context_data(self, **kwargs):
-        context = super().get_context_data()
-        product = Product.objects.get(slug=self.kwargs['slug'])
+        context = super().get_context_data(**kwargs)
+        product = self.object
         context['title'] = f'Товар {product.title}'
-        products = Product.objects.all()
-
-        data = []
-
-        for i in range(len(products)):
-            random_index = randint(0, len(products) - 1)
-            p = products[random_index]
-            if p not in data and product != p:
-                data.append(p)
-
-            context['products'] = data
-
+        context['breadcrumbs'] = get_breadcrumbs(product.category_id)
+        context['products'] = get_recommended_products(product)
         return context
 
 
@@ -133,15 +176,16 @@ def save_favorite_product(request, slug):
     if request.user.is_authenticated:
         user = request.user
         product = Product.objects.get(slug=slug)
-        favorite_products = FavoriteProduct.objects.filter(user=user)
+        favorite_ids = get_request_favorite_ids(request)
         if user:
-            if product not in [i.product for i in favorite_products]:
+            if product.pk not in favorite_ids:
                 messages.success(request, f'Товар {product.title} в избранном')
                 FavoriteProduct.objects.create(user=user, product=product)
+                favorite_ids.add(product.pk)
             else:
-                fav_product = FavoriteProduct.objects.get(user=user, product=product)
                 messages.warning(request, f'Товар {product.title} удалён из избранного')
-                fav_product.delete()
+                FavoriteProduct.objects.filter(user=user, product=product).delete()
+                favorite_ids.discard(product.pk)
 
         page = request.META.get('HTTP_REFERER', 'index')
         return redirect(page)
@@ -159,8 +203,7 @@ class FavoriteProductsView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         user = self.request.user
-        favorite_products = FavoriteProduct.objects.filter(user=user)
-        products = [i.product for i in favorite_products]
+        products = Product.objects.filter(favoriteproduct__user=user).select_related('primary_image')
         return products
 
 
@@ -174,6 +217,9 @@ def profile_view(request, pk):
         'order': cart_info['order'],
         'products': cart_info['products']
     }
+    # only the owner sees their orders
+    if request.user.pk == profile.user_id:
+        context['orders'] = get_order_history(request.user, request.GET.get('cursor'))
 
     return render(request, 'digital/profile.html', context)
 
@@ -236,45 +282,87 @@ def chg_account_view(request):
 
 
 def to_cart_view(request, action, pk):
-    if request.user.is_authenticated:
-        user_cart = CartForAuthenticatedUser(request, pk, action)
-        page = request.META.get('HTTP_REFERER', 'index')
-        if action == 'add':
-            messages.success(request, 'Товар добавлен в корзину')
-        elif action == 'del':
-            messages.success(request, 'Кол-во товара уменьшено')
+    user_cart = get_cart(request)
+    page = request.META.get('HTTP_REFERER', 'index')
+    try:
+        changed = user_cart.add_or_delete(pk, action)
+    except CheckoutInProgress:
+        messages.warning(request, CHECKOUT_IN_PROGRESS_MESSAGE)
         return redirect(page)
-    else:
-        messages.warning(request, 'Авторизуйтесь')
-        return redirect('login')
+    if action == 'add' and changed:
+        messages.success(request, 'Товар добавлен в корзину')
+    elif action == 'add':
+        messages.warning(request, 'Товара нет в наличии')
+    elif action == 'del' and changed:
+        messages.success(request, 'Кол-во товара уменьшено')
+    return redirect(page)
+
+
+@require_POST
+def cart_api(request):
+    try:
+        data = json.loads(request.body)
+        mode = data.get('mode', 'set')
+        quantities = {}
+        for operation in data['operations']:
+            product_id, quantity = int(operation['product_id']), int(operation['quantity'])
+            if quantity < 0:
+                raise ValueError(quantity)
+            quantities[product_id] = quantities.get(product_id, 0) + quantity if mode == 'add' else quantity
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return JsonResponse({'error': 'Ожидается {"mode": "set"|"add", "operations": [{"product_id", "quantity"}]}'},
+                            status=400)
+    if mode not in ('set', 'add'):
+        return JsonResponse({'error': 'Неизвестный режим'}, status=400)
+
+    user_cart = get_cart(request)
+    try:
+        if mode == 'add':
+            user_cart.add_products(quantities)
+            cart = user_cart.get_quantities()
+        else:
+            cart = user_cart.set_quantities(quantities)
+    except CheckoutInProgress:
+        return JsonResponse({'error': CHECKOUT_IN_PROGRESS_MESSAGE}, status=409)
+
+    return JsonResponse({
+        'cart': {str(product_id): quantity for product_id, quantity in cart.items()},
+        'summary': get_cart_summary(request)
+    })
 
 
 def my_cart_view(request):
-    if request.user.is_authenticated:
-        cart_info = get_cart_data(request)
+    cart_info = get_cart_data(request)
 
-        context = {
-            'title': 'Моя корзина',
-            'order': cart_info['order'],
-            'products': cart_info['products']
-        }
+    context = {
+        'title': 'Моя корзина',
+        'order': cart_info['order'],
+        'products': cart_info['products']
+    }
 
-        return render(request, 'digital/my_cart.html', context)
-    else:
-        return redirect('login')
+    return render(request, 'digital/my_cart.html', context)
 
 
 class SearchResults(ListView):
     model = Product
     context_object_name = 'products'
     template_name = 'digital/category_page.html'
+    paginate_by = 24
 
     def get_queryset(self):
-        word = self.request.GET.get('q')
-        products = Product.objects.filter(title__iregex=word)
+        return SearchResultsList(self.request.GET.get('q', ''))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['title'] = 'Поиск'
+        context['q'] = self.request.GET.get('q', '')
+        return context
 
-        print(word)
-        return products
+
+def search_suggestions(request):
+    return JsonResponse({
+        'suggestions': suggest(request.GET.get('q', ''))
+    })
 
 
 def chg_profile(request):
@@ -311,56 +399,83 @@ def checkout(request):
         return redirect('login')
 
 
-def create_checkout_session(request):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-    if request.method == 'POST':
-        user_cart = CartForAuthenticatedUser(request)
-        cart_info = user_cart.get_cart_info()
-
-        customer_form = CustomerForm(data=request.POST)
-        if customer_form.is_valid():
-            customer = Customer.objects.get(user=request.user)
-            customer.first_name = customer_form.cleaned_data['first_name']
-            customer.last_name = customer_form.cleaned_data['last_name']
-            customer.email = customer_form.cleaned_data['email']
-            customer.save()
-
-        shipping_form = ShippingForm(data=request.POST)
-        if shipping_form.is_valid():
-            address = shipping_form.save(commit=False)
-            address.customer = Customer.objects.get(user=request.user)
-            address.order = user_cart.get_cart_info()['order']
-            address.save()
+def prepare_checkout(request):
+    if not request.user.is_authenticated:
+        return None
+    user_cart = CartForAuthenticatedUser(request)
+    order = user_cart.get_order()
+    customer = order.customer
+
+    customer_form = CustomerForm(data=request.POST)
+    if customer_form.is_valid():
+        customer.first_name = customer_form.cleaned_data['first_name']
+        customer.last_name = customer_form.cleaned_data['last_name']
+        customer.email = customer_form.cleaned_data['email']
+        customer.save()
+
+    shipping_form = ShippingForm(data=request.POST)
+    if shipping_form.is_valid():
+        # a resubmitted checkout updates the address of the order instead of adding another one
+        ShippingAdress.objects.update_or_create(order=order, defaults={
+            'customer': customer, **shipping_form.cleaned_data})
 
-        else:
-            for field in shipping_form.errors:
-                messages.warning(request, shipping_form.errors[field].as_text())
-
-        total_price = cart_info['cart_total_price']
-        session = stripe.checkout.Session.create(
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': 'DigitalStore товары'
-                    },
-                    'unit_amount': int(total_price)
-                },
-                'quantity': 1
-            }],
-            mode='payment',
-            success_url=request.build_absolute_uri(reverse('success')),
-            cancel_url=request.build_absolute_uri(reverse('checkout'))
-        )
-        return redirect(session.url, 303)
+    else:
+        for field in shipping_form.errors:
+            messages.warning(request, shipping_form.errors[field].as_text())
+        return None
+
+    payments.start_checkout(order)
+    lines = order.orderproduct_set.values_list('product_id', 'quantity')
+    total_price = order.get_cart_total_price
+    if not total_price:
+        messages.warning(request, 'Корзина пуста')
+        return None
+    expires_at = payments.checkout_expires_at()
+    return {
+        'order': order,
+        'total_price': total_price,
+        'idempotency_key': payments.checkout_idempotency_key(order, lines, total_price, expires_at),
+        'expires_at': expires_at,
+        'success_url': request.build_absolute_uri(reverse('success')),
+        'cancel_url': request.build_absolute_uri(reverse('checkout'))
+    }
+
+
+async def create_checkout_session(request):
+    if request.method != 'POST':
+        return redirect('checkout')
+
+    checkout_data = await sync_to_async(prepare_checkout)(request)
+    if checkout_data is None:
+        return redirect('checkout')
+
+    try:
+        session = await payments.acreate_checkout_session(**checkout_data)
+    except stripe.error.StripeError:
+        await sync_to_async(messages.error)(request, 'Платёжный сервис недоступен, попробуйте позже')
+        return redirect('checkout')
+    await sync_to_async(payments.remember_checkout_session)(checkout_data['order'], session.id)
+
+    response = redirect(session.url)
+    response.status_code = 303
+    return response
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    try:
+        payments.record_payment_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''))
+    except (ValueError, stripe.error.SignatureVerificationError, ImproperlyConfigured):
+        # without STRIPE_WEBHOOK_SECRET nothing can be verified, Stripe keeps retrying the delivery
+        return HttpResponse(status=400)
+    return HttpResponse(status=200)
 
 
 def success_payment(request):
     if request.user.is_authenticated:
-        user_cart = CartForAuthenticatedUser(request)
-        # Реализовать логику сохранения заказа после оплаты
-
-        user_cart.clear()
+        # the order is finalized by process_payment_events once Stripe confirms the payment
+        request.session.pop(CART_SUMMARY_SESSION_KEY, None)
         messages.success(request, 'Оплата прошла успешно. Мы вас кинули спаибо покупайте ещё.')
         return render(request, 'digital/success.html')
 
@@ -369,15 +484,11 @@ def success_payment(request):
 
 
 def clear_cart(request):
-    user_cart = CartForAuthenticatedUser(request)
-    order = user_cart.get_cart_info()['order']
-    order_products = order.orderproduct_set.all()
-    for order_product in order_products:
-        quantity = order_product.quantity
-        product = order_product.product
-        order_product.delete()
-        product.quantity += quantity
-        product.save()
+    user_cart = get_cart(request)
+    try:
+        user_cart.release()
+    except CheckoutInProgress:
+        messages.warning(request, CHECKOUT_IN_PROGRESS_MESSAGE)
 
     return redirect('my_cart')
 
@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shop.settings')
 
 application = get_asgi_application()
+
+from digital.suggestions import warm_on_startup
+
+warm_on_startup()
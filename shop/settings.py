@@ -68,6 +68,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'digital.context_processors.favorites',
+                'digital.context_processors.cart_summary',
             ],
         },
     },
@@ -85,6 +87,35 @@ DATABASES = {
     }
 }
 
+FRAGMENT_CACHE_BACKEND = config('FRAGMENT_CACHE_BACKEND',
+                                default='django.core.cache.backends.filebased.FileBasedCache')
+
+CACHES = {
+    # the category tree and search suggestions announce changes to the other workers through this cache,
+    # with several workers it has to be shared (Redis, memcached), otherwise they only expire by timeout
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    },
+    # the file cache suits one server; it lists its whole directory on every write, so production
+    # should point FRAGMENT_CACHE_BACKEND at Redis or memcached (django.core.cache.backends.redis.RedisCache)
+    'fragments': {
+        'BACKEND': FRAGMENT_CACHE_BACKEND,
+        'LOCATION': config('FRAGMENT_CACHE_LOCATION', default=str(BASE_DIR / 'cache' / 'fragments')),
+    }
+}
+if FRAGMENT_CACHE_BACKEND.endswith(('FileBasedCache', 'LocMemCache')):
+    # a few cached fragments per product and category, the default of 300 entries would cull all the time
+    CACHES['fragments']['OPTIONS'] = {
+        'MAX_ENTRIES': config('FRAGMENT_CACHE_MAX_ENTRIES', default=50000, cast=int),
+    }
+
+# anonymous carts live in the session: signed_cookies or cache keeps browsing traffic off the database
+SESSION_ENGINE = config('SESSION_ENGINE', default='django.contrib.sessions.backends.db')
+
+# unpaid cart lines give their stock back after this many minutes, see release_expired_reservations
+CART_RESERVATION_MINUTES = config('CART_RESERVATION_MINUTES', default=60, cast=int)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -102,7 +133,11 @@ AUTH_PASSWORD_VALIDATORS = [
         'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator',
     },
 ]
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    # collectstatic subsets the fonts, then whitenoise fingerprints the files and writes .gz/.br copies
+    'staticfiles': {'BACKEND': 'digital.static_build.BuildStaticFilesStorage'},
+}
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
 
@@ -124,6 +159,9 @@ STATICFILES_DIRS = [
     BASE_DIR / 'digital/static'
 ]
 
+# build_static reports every page whose assets transfer more than this, compressed
+STATIC_BUDGET_KB = config('STATIC_BUDGET_KB', default=500, cast=int)
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = 'media'
 
@@ -143,3 +181,8 @@ MESSAGE_TAGS = {
 STRIPE_PUBLIC_KEY = 'pk_test_51KniXYAxRYRPHE83bbfdE4ksfdYA2pF8frneghPJUbP2CDE8tiFwzAnS92DVnkvC2hlzGIA0gEShDwXzK3HcRnxe009WCAo7Dc'
 
 STRIPE_SECRET_KEY = "sk_test_51KniXYAxRYRPHE83AnQt699xPMqf2yp8jmPl1qY1WhdG5AW7mFyKqLrGjsakvGO5KWb6VQBhCrXW0w3pq2ChmlGp0027FjhCDL"
+
+STRIPE_TIMEOUT = config('STRIPE_TIMEOUT', default=10, cast=int)
+STRIPE_MAX_NETWORK_RETRIES = config('STRIPE_MAX_NETWORK_RETRIES', default=2, cast=int)
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='')
+STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')
@@ -15,16 +15,15 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from shop import settings
-from django.conf.urls.static import static
+from digital import media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # uploads are served with validators and range support, a CDN in front keeps hashed names forever
+    re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>.+)$', media.serve, name='media'),
     path('', include('digital.urls'))
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-
 
@@ -5,4 +5,9 @@ from whitenoise import WhiteNoise
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shop.settings')
 
 application = get_wsgi_application()
+
+from digital.suggestions import warm_on_startup
+
+warm_on_startup()
+
 application = WhiteNoise(application)